@@ -11,7 +11,7 @@ from src.tasks.post_images import post_images
 from src.tasks.update_subs import update_subs
 
 task_conf = {
-    'update_subs': (47, update_subs),
+    'update_subs': (5, update_subs),
     'update_index': (13, update_index),
     'download_images': (8, download_images),
     'post_images': (5, post_images),
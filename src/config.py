@@ -1,14 +1,15 @@
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from functools import lru_cache
 from pathlib import Path
-from typing import Mapping, Generic, TypeVar, List, Tuple
+from typing import Mapping, Generic, TypeVar, List, Tuple, Optional
 
 from pip._vendor import toml
 
 from src.enums import ServiceType
 from src.services import APIConfig, parse_api
 from src.services.base import BaseService
+from src.utils.ratelimit import RateLimitConfig, parse_rate_limits
 
 T = TypeVar('T')
 
@@ -38,12 +39,52 @@ class ServerConfig:
     host: str
     port: int
     debug: bool
+    stats_ttl: int = 5
 
 
 @dataclass
 class LimitConfig:
     fetch: int
     download: int
+    # Upper bound of the threads polling one service type, which subscribe_concurrency lowers per type
+    subscribe_workers: int = 8
+    subscribe_timeout: int = 300
+    subscribe_concurrency: Mapping[str, int] = field(default_factory=dict)
+    # Minutes between two polls of one subscription
+    subscribe_interval: int = 47
+    subscribe_min_interval: int = 15
+    subscribe_max_interval: int = 7 * 24 * 60
+    download_workers: int = 8
+    download_host_connections: int = 4
+    # 0 uses one process per CPU
+    encode_processes: int = 0
+    # Minutes after which a claimed task is given to another worker, longer than any batch takes
+    claim_lease: int = 60
+
+    def subscribe_cap(self, stype: ServiceType) -> int:
+        return self.subscribe_concurrency.get(stype.value, 2)
+
+@dataclass
+class LaneConfig:
+    # Items of one push target posted at the same time, and claimed per run
+    workers: int = 2
+    batch: int = 20
+    # Pushes per second to the target, unlimited when not set
+    rate: Optional[float] = None
+    burst: int = 1
+    # Seconds a lane keeps claiming new batches, below the 5 minutes between two runs of post_images
+    budget: int = 240
+
+
+@dataclass
+class CacheConfig:
+    # Where new image blobs are stored, 'gridfs' or 'local'
+    backend: str = 'gridfs'
+    # Directory of the local backend, relative to the project root
+    root: str = 'cache'
+    # Images read from GridFS are buffered in memory up to this size, and in a temporary file above it
+    spool_size: int = 8 * 2 ** 20
+
 
 @dataclass
 class RootConfig:
@@ -52,6 +93,13 @@ class RootConfig:
     api: APIConfig
     pipeline: Mapping[str, PipelineConfig]
     limit: LimitConfig
+    ratelimit: RateLimitConfig
+    cache: CacheConfig
+    # Keyed like the push targets of pipelines, 'telegram:default_telegram'
+    lanes: Mapping[str, LaneConfig] = field(default_factory=dict)
+
+    def lane(self, stype: ServiceType, conf: str) -> LaneConfig:
+        return self.lanes.get(f"{stype.value}:{conf}", LaneConfig())
 
 
 
@@ -84,12 +132,21 @@ def parse_config(d) -> RootConfig:
         for nm, e in d['pipeline'].items()
     }
     limit = LimitConfig(**d['limit'])
+    ratelimit = parse_rate_limits(d.get('ratelimit', {}))
+    cache = CacheConfig(**d.get('cache', {}))
+    lanes = {
+        k: LaneConfig(**v)
+        for k, v in d.get('lane', {}).items()
+    }
     return RootConfig(
         server=server,
         db=db,
         api=api,
         pipeline=pipeline,
-        limit=limit
+        limit=limit,
+        ratelimit=ratelimit,
+        cache=cache,
+        lanes=lanes
     )
 
 
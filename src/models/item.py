@@ -1,9 +1,22 @@
-from typing import Optional, Union, List, Tuple, Iterable, IO
+import hashlib
+import time
+import uuid
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Optional, Union, List, Tuple, Iterable, IO, Dict, Set
 
 from mongoengine import *
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from src.data import FullItem, IndexItem
 from src.enums import ServiceType, TaskStage, TaskStatus, SecondaryTaskStatus
+from src.utils.blobstore import BlobStore, GridFSBlobStore, LocalBlobStore, get_blob_store
+from src.utils.images import ImageHandle, RenditionSpec, render_image, get_render_pool
+from src.utils.worker import get_worker_id
+
+
+FULL_ITEM_FIELDS = ('service', 'item_id', 'source_id', 'url', 'content', 'image_urls', 'tags', 'attachment_urls')
 
 
 class ItemInfo(DynamicDocument):
@@ -18,7 +31,8 @@ class ItemInfo(DynamicDocument):
 
     meta = {
         'indexes': [
-            {'fields': ['+service', '+item_id']},
+            # In this order so it doesn't clash with the non-unique (service, item_id) index of older databases
+            {'fields': ['+item_id', '+service'], 'unique': True},
         ]
     }
 
@@ -43,16 +57,61 @@ class ItemInfo(DynamicDocument):
             ItemChannel.objects(service=item.service, item_id=item.item_id, channel=ch).update_one(channel=ch, upsert=True)
 
     @classmethod
-    def poll_status_index(cls, stage: TaskStage, status: TaskStatus, limit=0) -> Iterable[FullItem]:
-        for st in TaskStatusInfo.objects(stage=stage, stage_status=status):
-            item = TaskStatusInfo.objects(service=st.service, item_id=st.item_id)[0]
+    def add_indexes(cls, items: List[IndexItem], channels: List[str], stage: TaskStage, status: TaskStatus):
+        """
+        Bulk version of add_index followed by set_status, one bulk_write per collection.
+        """
+        cls._bulk_add([
+            (it.service, it.item_id, {'item_id': it.item_id})
+            for it in items
+        ], channels, stage, status)
+
+    @classmethod
+    def add_items(cls, items: List[FullItem], channels: List[str], stage: TaskStage, status: TaskStatus):
+        """
+        Bulk version of add_item followed by set_status, one bulk_write per collection.
+        """
+        cls._bulk_add([
+            (it.service, it.item_id, {
+                'source_id': it.source_id,
+                'url': it.url,
+                'content': it.content,
+                'image_urls': it.image_urls,
+                'tags': it.tags,
+                'attachment_urls': it.attachment_urls,
+            })
+            for it in items
+        ], channels, stage, status)
+
+    @classmethod
+    def _bulk_add(cls, rows: List[Tuple[ServiceType, str, Dict]], channels: List[str], stage: TaskStage, status: TaskStatus):
+        if not rows:
+            return
+        bulk_upsert(cls, [
+            UpdateOne({'service': service.value, 'item_id': item_id}, {'$set': fields}, upsert=True)
+            for service, item_id, fields in rows
+        ])
+        if channels:
+            bulk_upsert(ItemChannel, [
+                UpdateOne({'service': service.value, 'item_id': item_id, 'channel': ch}, {'$set': {'channel': ch}}, upsert=True)
+                for service, item_id, _ in rows
+                for ch in channels
+            ])
+        # Subscriptions polled at the same time may add the same item, the first one sets its status
+        bulk_upsert(TaskStatusInfo, [
+            UpdateOne({'service': service.value, 'item_id': item_id}, {
+                '$setOnInsert': {'stage': stage.value, 'stage_status': status.value, 'worker_id': None, 'poll_counter': 0},
+            }, upsert=True)
+            for service, item_id, _ in rows
+        ])
+
+    @classmethod
+    def poll_status_index(cls, stage: TaskStage, status: TaskStatus, limit=0, worker_id: Optional[str] = None) -> Iterable[IndexItem]:
+        for st in TaskStatusInfo.claim(stage, status, limit, worker_id or get_worker_id()):
             yield IndexItem(
-                item_id=item.item_id,
-                service=item.service
+                item_id=st.item_id,
+                service=st.service
             )
-            limit -= 1
-            if limit == 0:
-                return
 
     def to_full_item(self):
         return FullItem(
@@ -67,15 +126,16 @@ class ItemInfo(DynamicDocument):
         )
 
     @classmethod
-    def poll_status(cls, stage: TaskStage, status: TaskStatus, limit=0) -> Iterable[FullItem]:
-        for st in TaskStatusInfo.objects(stage=stage, stage_status=status).order_by('poll_counter'):
-            item = cls.objects(service=st.service, item_id=st.item_id)[0]
-            st.poll_counter += 1
-            st.save()
-            yield item.to_full_item()
-            limit -= 1
-            if limit == 0:
-                return
+    def poll_status(cls, stage: TaskStage, status: TaskStatus, limit=0, worker_id: Optional[str] = None) -> Iterable[FullItem]:
+        claimed = TaskStatusInfo.claim(stage, status, limit, worker_id or get_worker_id())
+        items = cls.get_items([(st.service, st.item_id) for st in claimed])
+        for st in claimed:
+            item = items.get((st.service, st.item_id))
+            if item is None:
+                print("Missing item:", st.service, st.item_id)
+                cls.set_status(st.service, st.item_id, stage, TaskStatus.Failed)
+                continue
+            yield item
 
     @classmethod
     def abandon_tasks(cls, src_stage: TaskStage, src_status: TaskStatus, poll_limit: int, dst_stage: TaskStage, dst_status: TaskStatus):
@@ -96,40 +156,87 @@ class ItemInfo(DynamicDocument):
 
     @classmethod
     def set_status(cls, service: ServiceType, item_id: str, stage: TaskStage, status: TaskStatus):
-        TaskStatusInfo.objects(service=service, item_id=item_id).update_one(stage=stage, stage_status=status, upsert=True)
+        TaskStatusInfo.objects(service=service, item_id=item_id).update_one(
+            stage=stage, stage_status=status, worker_id=None, upsert=True
+        )
 
     @classmethod
-    def save_image(cls, item: FullItem, url: str, buffer: IO):
-        ImageCache.objects(service=item.service, item_id=item.item_id, url=url).update(url=url, upsert=True)
-        cache = ImageCache.objects(service=item.service, item_id=item.item_id, url=url)[0]
-        cache.file.replace(buffer, content_type="image/png")
-        cache.file.close()
-        cache.save()
+    def save_image(cls, item: FullItem, url: str, buffer: IO, content_type: str = "image/png") -> str:
+        """
+        Caches an image of the item, and returns the hash of its blob.
+        """
+        blob = ImageBlob.acquire(buffer.read(), content_type)
+        old = ImageCache.objects(service=item.service, item_id=item.item_id, url=url).modify(
+            upsert=True, new=False, url=url, **blob.entry_fields()
+        )
+        if old is not None:
+            old.release()
+        return blob.sha256
 
     @classmethod
-    def save_attachment_image(cls, item: FullItem, index: int, buffer: IO):
-        AttachmentImageCache.objects(service=item.service, item_id=item.item_id, image_index=index).delete()
-        cache = AttachmentImageCache(service=item.service, item_id=item.item_id, image_index=index)
-        cache.file.replace(buffer, content_type="image/png")
-        cache.file.close()
-        cache.save()
+    def save_attachment_image(cls, item: FullItem, index: int, buffer: IO, content_type: str = "image/png") -> str:
+        blob = ImageBlob.acquire(buffer.read(), content_type)
+        old = AttachmentImageCache.objects(service=item.service, item_id=item.item_id, image_index=index).modify(
+            upsert=True, new=False, image_index=index, **blob.entry_fields()
+        )
+        if old is not None:
+            old.release()
+        return blob.sha256
 
     @classmethod
-    def count_status(cls):
-        fetching = TaskStatusInfo.objects(stage=TaskStage.Fetching, stage_status=TaskStatus.Queued).count()
-        downloading = TaskStatusInfo.objects(stage=TaskStage.Downloading, stage_status=TaskStatus.Queued).count()
-        posting = TaskStatusInfo.objects(stage=TaskStage.Posting, stage_status=TaskStatus.Queued).count()
-        posting_pend = TaskStatusInfo.objects(stage=TaskStage.Posting, stage_status=TaskStatus.Pending).count()
-        cleaning = TaskStatusInfo.objects(stage=TaskStage.Cleaning, stage_status=TaskStatus.Queued).count()
-        done = TaskStatusInfo.objects(stage=TaskStage.Done, stage_status=TaskStatus.Queued).count()
-        failed = TaskStatusInfo.objects(stage_status=TaskStatus.Failed).count()
+    def status_matrix(cls):
+        """
+        Counts the tasks of every (stage, status) pair in one aggregation.
+        Returns the summary of the whole queue, plus one per service and one per pipeline (item channel).
+        Only unfinished tasks are joined with their channels, the done count of a pipeline is what is left
+        of its channel rows, which are counted without a join.
+        """
+        pipeline = [
+            {'$facet': {
+                'services': [
+                    {'$group': {
+                        '_id': {'service': '$service', 'stage': '$stage', 'status': '$stage_status'},
+                        'count': {'$sum': 1}
+                    }},
+                ],
+                'channels': [
+                    {'$match': {'stage': {'$ne': TaskStage.Done.value}}},
+                    {'$lookup': {
+                        'from': ItemChannel._get_collection_name(),
+                        'localField': 'item_id',
+                        'foreignField': 'item_id',
+                        'as': 'channels'
+                    }},
+                    {'$unwind': '$channels'},
+                    {'$match': {'$expr': {'$eq': ['$channels.service', '$service']}}},
+                    {'$group': {
+                        '_id': {'channel': '$channels.channel', 'stage': '$stage', 'status': '$stage_status'},
+                        'count': {'$sum': 1}
+                    }},
+                ],
+            }},
+        ]
+        result = next(TaskStatusInfo.objects.aggregate(pipeline, allowDiskUse=True))
+        total = {}
+        services = {}
+        channels = {}
+        for row in result['services']:
+            key = (row['_id']['stage'], row['_id']['status'])
+            total[key] = total.get(key, 0) + row['count']
+            counts = services.setdefault(row['_id']['service'], {})
+            counts[key] = counts.get(key, 0) + row['count']
+        for row in result['channels']:
+            key = (row['_id']['stage'], row['_id']['status'])
+            counts = channels.setdefault(row['_id']['channel'], {})
+            counts[key] = counts.get(key, 0) + row['count']
+        done = (TaskStage.Done.value, TaskStatus.Queued.value)
+        for row in ItemChannel.objects.aggregate([{'$group': {'_id': '$channel', 'count': {'$sum': 1}}}]):
+            counts = channels.setdefault(row['_id'], {})
+            counts[done] = max(row['count'] - sum(counts.values()), 0)
         return {
-            'fetching': fetching,
-            'downloading': downloading,
-            'posting': posting + posting_pend,
-            'cleaning': cleaning,
-            'done': done,
-            'failed': failed
+            'total': summarize_status(total),
+            'services': {ServiceType(k): summarize_status(v) for k, v in services.items() if k is not None},
+            'pipelines': {k: summarize_status(v) for k, v in channels.items()},
         }
 
     @classmethod
@@ -137,6 +244,23 @@ class ItemInfo(DynamicDocument):
         item = cls.objects(service=service, item_id=item_id)[0]
         return item.to_full_item()
 
+    @classmethod
+    def get_items(cls, keys: List[Tuple[ServiceType, str]]) -> Dict[Tuple[ServiceType, str], FullItem]:
+        """
+        Loads many items with a single $in query, keyed by (service, item_id).
+        """
+        if not keys:
+            return {}
+        wanted = set(keys)
+        services = {service for service, _ in wanted}
+        item_ids = {item_id for _, item_id in wanted}
+        q = cls.objects(service__in=list(services), item_id__in=list(item_ids)).only(*FULL_ITEM_FIELDS)
+        return {
+            (it.service, it.item_id): it.to_full_item()
+            for it in q
+            if (it.service, it.item_id) in wanted
+        }
+
     @classmethod
     def get_channels(cls, item: FullItem):
         return [
@@ -145,29 +269,43 @@ class ItemInfo(DynamicDocument):
         ]
 
     @classmethod
-    def get_images(cls, item: FullItem):
-        return [
-            ImageCache.objects(service=item.service, item_id=item.item_id, url=u)[0].file
-            for u in item.image_urls
-            if ImageCache.objects(service=item.service, item_id=item.item_id, url=u).count() > 0
-        ]
+    def get_channels_of(cls, keys: Iterable[Tuple[ServiceType, str]]) -> Dict[Tuple[ServiceType, str], List[str]]:
+        """
+        Batched version of get_channels, keyed by (service, item_id).
+        """
+        keys = set(keys)
+        if not keys:
+            return {}
+        result = {}
+        q = ItemChannel.objects(
+            service__in=list({s for s, _ in keys}), item_id__in=list({i for _, i in keys})
+        ).only('service', 'item_id', 'channel')
+        for c in q:
+            if (c.service, c.item_id) in keys:
+                result.setdefault((c.service, c.item_id), []).append(c.channel)
+        return result
 
     @classmethod
-    def get_attachment_images(cls, item: FullItem):
-        return [
-            f.file
-            for f in AttachmentImageCache.objects(service=item.service, item_id=item.item_id).order_by('image_index')
-        ]
+    def get_images(cls, item: FullItem) -> List[ImageHandle]:
+        caches = {
+            c.url: c
+            for c in ImageCache.objects(service=item.service, item_id=item.item_id, url__in=item.image_urls)
+        }
+        caches = [caches[u] for u in item.image_urls if u in caches]
+        return ImageBlob.handles(caches)
+
+    @classmethod
+    def get_attachment_images(cls, item: FullItem) -> List[ImageHandle]:
+        caches = AttachmentImageCache.objects(service=item.service, item_id=item.item_id).order_by('image_index')
+        return ImageBlob.handles(list(caches))
 
     @classmethod
     def clean_cache(cls, item: FullItem):
         for c in ImageCache.objects(service=item.service, item_id=item.item_id):
-            c.file.delete()
-            c.save()
+            c.release()
         ImageCache.objects(service=item.service, item_id=item.item_id).delete()
         for c in AttachmentImageCache.objects(service=item.service, item_id=item.item_id):
-            c.file.delete()
-            c.save()
+            c.release()
         AttachmentImageCache.objects(service=item.service, item_id=item.item_id).delete()
 
     @classmethod
@@ -175,10 +313,33 @@ class ItemInfo(DynamicDocument):
         return TaskStatusInfo.objects(service=service, item_id=item_id).count() > 0
 
     @classmethod
-    def clean_pending_items(cls):
+    def existing_keys(cls, keys: Iterable[Tuple[ServiceType, str]]) -> Set[Tuple[ServiceType, str]]:
+        """
+        Batched version of exists, checks many (service, item_id) pairs with a single $in query.
+        """
+        keys = set(keys)
+        if not keys:
+            return set()
+        services = {service for service, _ in keys}
+        item_ids = {item_id for _, item_id in keys}
+        q = TaskStatusInfo.objects(service__in=list(services), item_id__in=list(item_ids)).only('service', 'item_id')
+        return {(st.service, st.item_id) for st in q} & keys
+
+    @classmethod
+    def clean_pending_items(cls, worker_id: Optional[str] = None):
+        # Only release the claims of this worker, other workers of the same stage may still be running.
+        # Claims made before workers had an id have no owner and are released by everyone.
+        owners = [worker_id or get_worker_id(), None]
         stages = [TaskStage.Fetching, TaskStage.Downloading]
-        TaskStatusInfo.objects(stage__in=stages, stage_status=TaskStatus.Pending).update(stage_status=TaskStatus.Failed)
-        SecondaryTask.objects(status=SecondaryTaskStatus.Pending).update(status=SecondaryTaskStatus.Queued)
+        TaskStatusInfo.objects(stage__in=stages, stage_status=TaskStatus.Pending, worker_id__in=owners).update(
+            stage_status=TaskStatus.Failed, worker_id=None
+        )
+        TaskStatusInfo.objects(stage=TaskStage.Cleaning, stage_status=TaskStatus.Pending, worker_id__in=owners).update(
+            stage_status=TaskStatus.Queued, worker_id=None
+        )
+        SecondaryTask.objects(status=SecondaryTaskStatus.Pending, worker_id__in=owners).update(
+            status=SecondaryTaskStatus.Queued, worker_id=None
+        )
 
         for t in TaskStatusInfo.objects(stage=TaskStage.Posting, stage_status=TaskStatus.Queued):
             if SecondaryTask.task_done(t.service, t.item_id):
@@ -187,15 +348,54 @@ class ItemInfo(DynamicDocument):
 
     @classmethod
     def get_failures(cls, service: ServiceType, stage: TaskStage):
-        return [
-            cls.get_item(service=service, item_id=st.item_id)
-            for st in TaskStatusInfo.objects(stage=stage, service=service, stage_status=TaskStatus.Failed).order_by('-item_id')
+        keys = [
+            (st.service, st.item_id)
+            for st in TaskStatusInfo.objects(stage=stage, service=service, stage_status=TaskStatus.Failed).order_by('-item_id').only('service', 'item_id')
         ]
+        items = cls.get_items(keys)
+        return [items[k] for k in keys if k in items]
 
     @classmethod
     def retry_failure(cls, service: ServiceType, item_id: str):
         TaskStatusInfo.objects(service=service, item_id=item_id).update(stage_status=TaskStatus.Queued, poll_counter=0)
 
+def summarize_status(counts: Dict[Tuple[str, str], int]):
+    def count(stage: TaskStage, status: TaskStatus):
+        return counts.get((stage.value, status.value), 0)
+
+    return {
+        'fetching': count(TaskStage.Fetching, TaskStatus.Queued),
+        'downloading': count(TaskStage.Downloading, TaskStatus.Queued),
+        'posting': count(TaskStage.Posting, TaskStatus.Queued) + count(TaskStage.Posting, TaskStatus.Pending),
+        'cleaning': count(TaskStage.Cleaning, TaskStatus.Queued),
+        'done': count(TaskStage.Done, TaskStatus.Queued),
+        'failed': sum(c for (_, status), c in counts.items() if status == TaskStatus.Failed.value)
+    }
+
+
+def bulk_upsert(doc_cls, ops: List[UpdateOne]):
+    """
+    Runs upserts in one unordered bulk write. Upserts that lost an insert race against another writer
+    fail on the unique index, they are run again and then update the document that won.
+    """
+    try:
+        doc_cls._get_collection().bulk_write(ops, ordered=False)
+    except BulkWriteError as err:
+        errors = err.details.get('writeErrors', [])
+        if any(e['code'] != 11000 for e in errors):
+            raise
+        doc_cls._get_collection().bulk_write([ops[e['index']] for e in errors], ordered=False)
+
+
+def lease_expiry() -> datetime:
+    """
+    Claims made before this time are abandoned, their worker died or was replaced by a new container.
+    """
+    # Imported here, the push services use this module and src.config imports them
+    from src.config import load_config
+    return datetime.utcnow() - timedelta(minutes=load_config().limit.claim_lease)
+
+
 class ItemChannel(DynamicDocument):
     service = EnumField(ServiceType)
     item_id = StringField()
@@ -204,6 +404,7 @@ class ItemChannel(DynamicDocument):
     meta = {
         'indexes': [
             {'fields': ['+service', '+item_id', '+channel']},
+            {'fields': ['+item_id']},
         ]
     }
 
@@ -214,20 +415,246 @@ class TaskStatusInfo(DynamicDocument):
     stage = EnumField(TaskStage)
     stage_status = EnumField(TaskStatus)
     poll_counter = IntField(default=0)
+    worker_id = StringField(null=True)
+    claim_token = StringField(null=True)
+    claimed_at = DateTimeField(null=True)
 
     meta = {
         'indexes': [
-            {'fields': ['+service', '+item_id']},
+            {'fields': ['+item_id', '+service'], 'unique': True},
             {'fields': ['+stage', '+stage_status']},
             {'fields': ['+stage', '+stage_status', '+poll_counter']},
+            {'fields': ['+claim_token']},
         ]
     }
 
+    @classmethod
+    def claim(cls, stage: TaskStage, status: TaskStatus, limit: int, worker_id: str) -> List['TaskStatusInfo']:
+        """
+        Claims up to `limit` tasks (0 for all of them) of a stage for a worker.
+        The claimed tasks are switched to Pending, tagged with the worker id and get their poll counter bumped
+        in a single update, which only matches tasks still in `status`. A task can't be claimed by two workers.
+        Claims older than the lease are put back to `status` first, whichever worker made them.
+        Posting is left alone: a Pending item there has its secondary tasks queued, which have their own lease.
+        """
+        if stage != TaskStage.Posting:
+            cls.objects(stage=stage, stage_status=TaskStatus.Pending, claimed_at__lt=lease_expiry()).update(
+                stage_status=status, worker_id=None, claim_token=None
+            )
+        candidates = cls.objects(stage=stage, stage_status=status).order_by('poll_counter').only('id').limit(limit)
+        candidate_ids = [st.id for st in candidates]
+        if not candidate_ids:
+            return []
+        token = uuid.uuid4().hex
+        cls.objects(id__in=candidate_ids, stage=stage, stage_status=status).update(
+            stage_status=TaskStatus.Pending,
+            worker_id=worker_id,
+            claim_token=token,
+            claimed_at=datetime.utcnow(),
+            inc__poll_counter=1
+        )
+        return list(cls.objects(claim_token=token).order_by('poll_counter'))
+
+
+class ImageBlob(DynamicDocument):
+    """
+    Cached image bytes, stored once per distinct content and shared by every cache entry with the same hash.
+    The blob is deleted when the last entry referencing it is released.
+    The bytes live in the blob store named by `backend`, blobs without one are in GridFS.
+    A blob being deleted keeps its document as a tombstone until its bytes are gone, and can't be acquired.
+    """
+    sha256 = StringField()
+    content_type = StringField()
+    size = IntField()
+    refcount = IntField(default=0)
+    backend = StringField(null=True)
+    deleting_at = DateTimeField(null=True)
+
+    # A tombstone older than this was left by a worker that died while deleting
+    TOMBSTONE_TIMEOUT = timedelta(minutes=5)
 
-class ImageCache(DynamicDocument):
+    meta = {
+        'indexes': [
+            {'fields': ['+sha256'], 'unique': True},
+        ]
+    }
+
+    @property
+    def store(self) -> BlobStore:
+        return get_blob_store(self.backend or GridFSBlobStore.name)
+
+    @classmethod
+    def acquire(cls, data: bytes, content_type: str) -> 'ImageBlob':
+        """
+        Adds a reference to the blob holding `data`, storing it first if it is new.
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        while True:
+            blob = cls.objects(sha256=sha256, deleting_at=None).modify(inc__refcount=1, new=True)
+            if blob is None:
+                tombstone = cls.objects(sha256=sha256, deleting_at__ne=None).first()
+                if tombstone is not None:
+                    if datetime.utcnow() - tombstone.deleting_at > cls.TOMBSTONE_TIMEOUT:
+                        tombstone.purge()
+                    else:
+                        time.sleep(0.1)
+                    continue
+                store = get_blob_store()
+                blob = cls(sha256=sha256, content_type=content_type, size=len(data), refcount=1, backend=store.name)
+                try:
+                    blob.save()
+                except NotUniqueError:
+                    # Another worker saved the same bytes in the meantime
+                    continue
+            # Written after taking the reference, the bytes can't be deleted by a release from now on.
+            # The writer of the document may still be storing them, put is a no-op when they are there.
+            try:
+                blob.store.put(sha256, data, content_type)
+            except BaseException:
+                cls.release(sha256)
+                raise
+            return blob
+
+    @classmethod
+    def release(cls, sha256: str):
+        blob = cls.objects(sha256=sha256).modify(dec__refcount=1, new=True)
+        if blob is None or blob.refcount > 0:
+            return
+        # Only deleted if nobody acquired it again since the decrement
+        blob = cls.objects(sha256=sha256, refcount__lte=0, deleting_at=None).modify(
+            set__deleting_at=datetime.utcnow(), new=True
+        )
+        if blob is not None:
+            blob.purge()
+
+    def purge(self):
+        # The bytes go first, the blob can only be stored again once the tombstone is removed
+        self.store.delete(self.sha256)
+        self.__class__.objects(id=self.id).delete()
+        ImageRendition.release_source(self.sha256)
+
+    def entry_fields(self):
+        """
+        Copied to the cache entries referencing the blob, so their images can be listed without loading the blob.
+        """
+        return dict(sha256=self.sha256, content_type=self.content_type, size=self.size, backend=self.backend)
+
+    @staticmethod
+    def handle(entry, spool_size: int) -> ImageHandle:
+        """
+        Handle on the blob described by `entry`, a blob, cache entry or rendition with the fields of `entry_fields`.
+        """
+        store = get_blob_store(entry.backend or GridFSBlobStore.name)
+        return ImageHandle(
+            partial(store.open, entry.sha256), entry.content_type, entry.size, entry.sha256,
+            remote=store.remote, spool_size=spool_size,
+            path=store.path(entry.sha256) if isinstance(store, LocalBlobStore) else None
+        )
+
+    @classmethod
+    def handles(cls, caches: List[Union['ImageCache', 'AttachmentImageCache']]) -> List[ImageHandle]:
+        """
+        Lazy handles on the images of cache entries.
+        Blobs are only loaded for entries saved before their fields were copied to the entries,
+        entries saved before the cache was content addressed keep their own file.
+        """
+        # Imported here, the push services use this module and src.config imports them
+        from src.config import load_config
+        spool_size = load_config().cache.spool_size
+        hashes = {c.sha256 for c in caches if c.sha256 and not c.content_type}
+        blobs = {b.sha256: b for b in cls.objects(sha256__in=list(hashes))} if hashes else {}
+        handles = []
+        for c in caches:
+            if c.sha256 in blobs:
+                c = blobs[c.sha256]
+            if c.sha256 and c.content_type:
+                handles.append(cls.handle(c, spool_size))
+            elif c.file:
+                handles.append(ImageHandle(
+                    partial(c.file.fs.get, c.file.grid_id), c.file.content_type, c.file.length,
+                    remote=True, spool_size=spool_size
+                ))
+        return handles
+
+
+class ImageRendition(DynamicDocument):
+    """
+    A resized copy of a blob, kept until the blob itself is deleted.
+    Holds a reference on the blob of the copy, its fields are the `entry_fields` of that blob.
+    """
+    source = StringField()
+    spec = StringField()
+    sha256 = StringField()
+    content_type = StringField()
+    size = IntField()
+    backend = StringField(null=True)
+
+    meta = {
+        'indexes': [
+            {'fields': ['+source', '+spec'], 'unique': True},
+        ]
+    }
+
+    @classmethod
+    def render(cls, image: ImageHandle, spec: RenditionSpec) -> Optional[ImageHandle]:
+        """
+        The image resized to `spec`, rendered in the process pool the first time and read from the cache after that.
+        Returns None when the image is too small to be resized.
+        """
+        from src.config import load_config
+        config = load_config()
+        if image.sha256 is not None:
+            r = cls.objects(source=image.sha256, spec=spec.key).first()
+            if r is not None:
+                return ImageBlob.handle(r, config.cache.spool_size)
+        data = get_render_pool(config.limit.encode_processes).submit(render_image, image.read(), spec).result()
+        if data is None:
+            return None
+        if image.sha256 is None:
+            return ImageHandle.from_bytes(data, spec.content_type)
+        return ImageBlob.handle(cls.put(image.sha256, spec, data), config.cache.spool_size)
+
+    @classmethod
+    def put(cls, source: str, spec: RenditionSpec, data: bytes) -> 'ImageRendition':
+        blob = ImageBlob.acquire(data, spec.content_type)
+        r = cls(source=source, spec=spec.key, **blob.entry_fields())
+        try:
+            r.save()
+        except NotUniqueError:
+            # Rendered by another worker at the same time
+            ImageBlob.release(blob.sha256)
+            r = cls.objects(source=source, spec=spec.key).first()
+        return r
+
+    @classmethod
+    def exists(cls, source: str, spec: RenditionSpec) -> bool:
+        return cls.objects(source=source, spec=spec.key).count() > 0
+
+    @classmethod
+    def release_source(cls, source: str):
+        for r in cls.objects(source=source):
+            # Two workers purging the same source only release each rendition once
+            if cls.objects(id=r.id).delete():
+                ImageBlob.release(r.sha256)
+
+
+class CacheEntry:
+    def release(self):
+        if self.sha256:
+            ImageBlob.release(self.sha256)
+        elif self.file:
+            self.file.delete()
+
+
+class ImageCache(CacheEntry, DynamicDocument):
     service = EnumField(ServiceType)
     item_id = StringField()
     url = StringField()
+    sha256 = StringField(null=True)
+    content_type = StringField(null=True)
+    size = IntField(null=True)
+    backend = StringField(null=True)
+    # Only set on entries written before the cache was content addressed
     file = FileField()
 
     meta = {
@@ -237,10 +664,15 @@ class ImageCache(DynamicDocument):
     }
 
 
-class AttachmentImageCache(DynamicDocument):
+class AttachmentImageCache(CacheEntry, DynamicDocument):
     service = EnumField(ServiceType)
     item_id = StringField()
     image_index = IntField()
+    sha256 = StringField(null=True)
+    content_type = StringField(null=True)
+    size = IntField(null=True)
+    backend = StringField(null=True)
+    # Only set on entries written before the cache was content addressed
     file = FileField()
 
     meta = {
@@ -258,6 +690,9 @@ class SecondaryTask(DynamicDocument):
     status = EnumField(SecondaryTaskStatus)
     poll_counter = IntField(default=0)
     channel = StringField()
+    worker_id = StringField(null=True)
+    claim_token = StringField(null=True)
+    claimed_at = DateTimeField(null=True)
 
     meta = {
         'indexes': [
@@ -266,6 +701,7 @@ class SecondaryTask(DynamicDocument):
             {'fields': ['+status', '+poll_counter']},
             {'fields': ['+post_service', '+post_conf', '+status']},
             {'fields': ['+pull_service', '+item_id', '+status']},
+            {'fields': ['+claim_token']},
         ]
     }
 
@@ -275,33 +711,83 @@ class SecondaryTask(DynamicDocument):
             pull_service=pull_service, item_id=item_id,
             post_service=post_service, post_conf=post_conf,
             channel=channel
-        ).update_one(status=SecondaryTaskStatus.Queued, upsert=True)
+        ).update_one(set_on_insert__status=SecondaryTaskStatus.Queued, upsert=True)
 
     @classmethod
-    def acquire_task(cls, pull_service: ServiceType, item_id: str, post_service: ServiceType, post_conf: str, channel: str):
+    def release_task(cls, pull_service: ServiceType, item_id: str, post_service: ServiceType, post_conf: str, channel: str):
         cls.objects(
             pull_service=pull_service, item_id=item_id,
             post_service=post_service, post_conf=post_conf,
             channel=channel
-        ).update_one(status=SecondaryTaskStatus.Pending)
+        ).update_one(status=SecondaryTaskStatus.Queued, worker_id=None)
 
     @classmethod
-    def release_task(cls, pull_service: ServiceType, item_id: str, post_service: ServiceType, post_conf: str, channel: str):
+    def defer_task(cls, pull_service: ServiceType, item_id: str, post_service: ServiceType, post_conf: str, channel: str):
+        """
+        Queues a task again without counting the attempt, when the push target asked us to wait.
+        """
         cls.objects(
             pull_service=pull_service, item_id=item_id,
             post_service=post_service, post_conf=post_conf,
             channel=channel
-        ).update_one(status=SecondaryTaskStatus.Queued)
+        ).update_one(status=SecondaryTaskStatus.Queued, worker_id=None, dec__poll_counter=1)
 
     @classmethod
-    def poll_tasks(cls, limit=1) -> Iterable[Tuple[ServiceType, str, ServiceType, str, str, int]]:
-        for it in cls.objects(status=SecondaryTaskStatus.Queued).order_by('poll_counter'):
-            it.poll_counter += 1
-            it.save()
-            yield it.pull_service, it.item_id, it.post_service, it.post_conf, it.channel, it.poll_counter
-            limit -= 1
-            if limit <= 0:
+    def claim_items(cls, limit: int, worker_id: str, post_service: Optional[ServiceType] = None,
+                    post_conf: Optional[str] = None, exclude: Set[Tuple[ServiceType, str]] = frozenset()
+                    ) -> Dict[Tuple[ServiceType, str], List['SecondaryTask']]:
+        """
+        Claims every queued task of up to `limit` items, so an item is loaded once for all of its targets.
+        Works like TaskStatusInfo.claim, the tasks are returned grouped by (pull_service, item_id).
+        With `post_service` and `post_conf`, only the tasks of that push target are claimed.
+        Items in `exclude` are skipped.
+        """
+        target = {}
+        if post_service is not None:
+            target = dict(post_service=post_service, post_conf=post_conf)
+        cls.objects(status=SecondaryTaskStatus.Pending, claimed_at__lt=lease_expiry(), **target).update(
+            status=SecondaryTaskStatus.Queued, worker_id=None, claim_token=None
+        )
+        keys = set()
+        queued = cls.objects(status=SecondaryTaskStatus.Queued, **target).order_by('poll_counter')
+        for t in queued.only('pull_service', 'item_id'):
+            if (t.pull_service, t.item_id) in exclude:
+                continue
+            keys.add((t.pull_service, t.item_id))
+            if len(keys) >= limit:
                 break
+        if not keys:
+            return {}
+        token = uuid.uuid4().hex
+        cls.objects(
+            pull_service__in=list({s for s, _ in keys}), item_id__in=list({i for _, i in keys}),
+            status=SecondaryTaskStatus.Queued, **target
+        ).update(
+            status=SecondaryTaskStatus.Pending,
+            worker_id=worker_id,
+            claim_token=token,
+            claimed_at=datetime.utcnow(),
+            inc__poll_counter=1
+        )
+        claimed = {}
+        for t in cls.objects(claim_token=token).order_by('poll_counter'):
+            claimed.setdefault((t.pull_service, t.item_id), []).append(t)
+        return claimed
+
+    @classmethod
+    def fanout_items(cls) -> Set[Tuple[ServiceType, str]]:
+        """
+        Items with more than one queued task, they are posted to several targets or channels.
+        """
+        pipeline = [
+            {'$match': {'status': SecondaryTaskStatus.Queued.value}},
+            {'$group': {'_id': {'service': '$pull_service', 'item_id': '$item_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ]
+        return {
+            (ServiceType(row['_id']['service']), row['_id']['item_id'])
+            for row in cls.objects.aggregate(pipeline, allowDiskUse=True)
+        }
 
     @classmethod
     def close_task(cls, pull_service: ServiceType, item_id: str, post_service: ServiceType, post_conf: str, channel: str):
@@ -309,7 +795,7 @@ class SecondaryTask(DynamicDocument):
             pull_service=pull_service, item_id=item_id,
             post_service=post_service, post_conf=post_conf,
             channel=channel
-        ).update_one(status=SecondaryTaskStatus.Finished)
+        ).update_one(status=SecondaryTaskStatus.Finished, worker_id=None)
 
     @classmethod
     def migrate_task(cls, post_service1, post_conf1, post_service2, post_conf2):
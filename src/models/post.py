@@ -1,4 +1,7 @@
+from typing import Iterable
+
 from mongoengine import *
+from pymongo import UpdateOne
 
 from src.enums import ServiceType
 
@@ -24,4 +27,23 @@ class PostRecord(DynamicDocument):
                     pull_service=pull_service, pull_id=pull_id,
                     post_service=post_service, post_id=post_id, channel=channel,
                     upsert=True
-                    )
\ No newline at end of file
+                    )
+
+    @classmethod
+    def put_records(cls, pull_service: ServiceType, pull_id: str, post_service: ServiceType, post_ids: Iterable[str], channel: str):
+        """
+        Batched version of put_record for everything an item was posted as, in one bulk write.
+        """
+        records = [
+            {
+                'pull_service': pull_service.value, 'pull_id': pull_id,
+                'post_service': post_service.value, 'post_id': post_id, 'channel': channel
+            }
+            for post_id in post_ids
+        ]
+        if not records:
+            return
+        cls._get_collection().bulk_write([
+            UpdateOne(r, {'$set': r}, upsert=True)
+            for r in records
+        ], ordered=False)
@@ -1,4 +1,5 @@
-from typing import List, Iterable, Tuple
+from datetime import datetime, timedelta
+from typing import List, Iterable, Tuple, Optional
 
 from mongoengine import *
 
@@ -9,11 +10,17 @@ class SubscribeSource(DynamicDocument):
     service_type = EnumField(ServiceType)
     service_func = StringField()
     name = StringField()
+    cursor = StringField(null=True)
+    last_poll_at = DateTimeField(null=True)
+    next_poll_at = DateTimeField(null=True)
+    poll_interval = IntField(null=True)
+    yield_rate = FloatField(null=True)
 
     meta = {
         'indexes': [
             {'fields': ['+service_type', '+service_func']},
             {'fields': ['+service_type', '+service_func', '+name']},
+            {'fields': ['+service_type', '+service_func', '+next_poll_at']},
         ]
     }
 
@@ -39,6 +46,32 @@ class SubscribeSource(DynamicDocument):
             channels = list(cls.get_channels(stype, sfunc, it.name))
             yield it.name, channels
 
+    @classmethod
+    def get_due_subs(cls, stype: ServiceType, sfunc: str, now: datetime) -> Iterable[Tuple['SubscribeSource', List[str]]]:
+        """
+        Subscriptions whose next poll is due, sources that were never polled are always due.
+        """
+        channels = {}
+        for it in SubscribeChannel.objects(service_type=stype, service_func=sfunc).only('name', 'channel'):
+            channels.setdefault(it.name, []).append(it.channel)
+        q = cls.objects(Q(next_poll_at__lte=now) | Q(next_poll_at=None), service_type=stype, service_func=sfunc)
+        for it in q:
+            yield it, channels.get(it.name, [])
+
+    @classmethod
+    def set_cursor(cls, stype: ServiceType, sfunc: str, name: str, cursor: str):
+        cls.objects(service_type=stype, service_func=sfunc, name=name).update_one(cursor=cursor)
+
+    @classmethod
+    def schedule_poll(cls, stype: ServiceType, sfunc: str, name: str, polled_at: datetime, interval: timedelta,
+                      yield_rate: Optional[float]):
+        cls.objects(service_type=stype, service_func=sfunc, name=name).update_one(
+            last_poll_at=polled_at,
+            next_poll_at=polled_at + interval,
+            poll_interval=int(interval.total_seconds()),
+            yield_rate=yield_rate
+        )
+
     @classmethod
     def get_subs_by_channel(cls, stype: ServiceType, sfunc: str, channel: str) -> Iterable[Tuple[str, List[str]]]:
         for it in SubscribeChannel.objects(service_type=stype, service_func=sfunc, channel=channel):
@@ -1,4 +1,4 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, Set
 
 from mongoengine import *
 
@@ -7,19 +7,39 @@ class ServiceKVStore(DynamicDocument):
     key_name = StringField()
     value = DictField()
 
+    meta = {
+        'indexes': [
+            {'fields': ['+service_name', '+key_name']},
+        ]
+    }
+
     @classmethod
     def get(cls, service_name, key) -> Optional[Dict]:
         q = cls.objects(service_name=service_name, key_name=key)
         if q.count() == 0:
             return None
         else:
-            return q[1].value
+            return q[0].value
 
     @classmethod
     def put(cls, service_name, key, value: Dict) -> Optional[Dict]:
         cls.objects(service_name=service_name, key_name=key).update_one(value=value, upsert=True)
 
+    @classmethod
+    def delete(cls, service_name, key):
+        cls.objects(service_name=service_name, key_name=key).delete()
+
     @classmethod
     def exists(cls, service_name, key) -> bool:
         q = cls.objects(service_name=service_name, key_name=key)
         return q.count() > 0
+
+    @classmethod
+    def keys(cls, service_prefix: str) -> Dict[str, Set[str]]:
+        """
+        The keys of every service whose name starts with `service_prefix`, in one query.
+        """
+        result = {}
+        for kv in cls.objects(service_name__startswith=service_prefix).only('service_name', 'key_name'):
+            result.setdefault(kv.service_name, set()).add(kv.key_name)
+        return result
@@ -2,7 +2,7 @@ from dataclasses import dataclass
 from typing import Callable, Any, Mapping, Tuple, Type, Dict
 
 from src.enums import ServiceType
-from src.services.base import PullService, PushService, SubscribeService
+from src.services.base import PullService, PushService, SubscribeService, PushDeferred
 from src.services.fanbox import FanboxUsernameSubs, FanboxService, FanboxReflect, FanboxConfig
 from src.services.local import LocalService, LocalConfig
 # from src.services.megasync import MegaService, MegaConfig
@@ -3,15 +3,20 @@ from abc import ABC, abstractmethod
 from typing import Union, Iterable, IO, Optional, List
 
 from src.data import IndexItem, FullItem
+from src.utils.images import ImageHandle, RenditionSpec
 
 
 class SubscribeService(ABC):
+    """
+    Subscriptions yield their items newest first.
+    `cursor` is the id of the newest item of the previous poll, services stop listing when they reach it.
+    """
     @abstractmethod
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
         return []
 
     @abstractmethod
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         return []
 
     @classmethod
@@ -51,14 +56,44 @@ class PullService(ABC):
         return []
 
 
+class PushDeferred(Exception):
+    """
+    Raised by a push service when the target asked to slow down.
+    The task is queued again later, without counting as a failed attempt.
+    """
+
+    def __init__(self, retry_after: float):
+        super(PushDeferred, self).__init__(f"Retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
 class PushService(ABC):
     @abstractmethod
-    def push_item(self, item: FullItem, images: Iterable[IO], channel: str, converted_username: str):
+    def push_item(self, item: FullItem, images: List[ImageHandle], channel: str, converted_username: str,
+                  attempt: int = 1):
+        """
+        Images are read from the cache when they are opened, in the format they were downloaded in.
+        Open them as late as possible and close them once sent.
+        `attempt` counts the tries of this task, from 1. Deferred tries don't count.
+        """
         pass
 
     @staticmethod
     def push_limit():
         return 20
 
+    @classmethod
+    def renditions(cls) -> List[RenditionSpec]:
+        """
+        Resized copies of the images the service sends, they are rendered ahead when the images are downloaded.
+        """
+        return []
+
+    def report(self):
+        """
+        Prints the stats the service collected since the last report.
+        """
+        pass
+
 
 BaseService = Union[SubscribeService, PullService, PushService]
@@ -1,6 +1,5 @@
 import os.path
 import re
-import time
 from dataclasses import dataclass
 from io import BytesIO
 from typing import Optional, IO, Iterable, List
@@ -11,6 +10,7 @@ from src.models.user import UserInfo
 from src.services import PullService, SubscribeService
 from src.services.fanbox.utils import FanboxApi
 from src.utils.network import get_session_from_cookies_file
+from src.utils.ratelimit import rate_limited
 
 
 @dataclass
@@ -22,7 +22,7 @@ class FanboxServiceBase:
     config: FanboxConfig
     def __init__(self, config: FanboxConfig):
         self.config = config
-        self.sess = get_session_from_cookies_file(config.cookies)
+        self.sess = rate_limited(get_session_from_cookies_file(config.cookies), ServiceType.Fanbox)
         self.api = FanboxApi(self.sess)
 
     def get_nickname(self, name: str):
@@ -64,7 +64,6 @@ class FanboxService(FanboxServiceBase, PullService):
         )
 
     def download_item_image(self, item: FullItem, url: str) -> IO:
-        time.sleep(5)
         return BytesIO(self.api.download_image(url))
 
     @classmethod
@@ -96,12 +95,20 @@ class FanboxService(FanboxServiceBase, PullService):
 
 
 class FanboxUsernameSubs(FanboxServiceBase, SubscribeService):
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
-        for post_id in self.api.list_creator_posts(name, 30):
-            uid = self.to_item_id(name, post_id)
-            yield IndexItem(ServiceType.Fanbox, uid)
-
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
+        if cursor is None:
+            for post_id in self.api.list_creator_posts(name, 30):
+                uid = self.to_item_id(name, post_id)
+                yield IndexItem(ServiceType.Fanbox, uid)
+            return
+        # Follow nextUrl until the newest post of the previous poll
+        _, last_id = self.split_item_id(cursor)
+        for artist, post_id in self.api.iter_creator_posts(name, 30):
+            if post_id <= last_id:
+                break
+            yield IndexItem(ServiceType.Fanbox, self.to_item_id(artist, post_id))
+
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         return []
 
     @classmethod
@@ -114,7 +121,7 @@ class FanboxUsernameSubs(FanboxServiceBase, SubscribeService):
 
 
 class FanboxReflect(FanboxServiceBase, SubscribeService):
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
         if name == 'home':
             home = self.api.list_home(30)
             return [
@@ -136,7 +143,7 @@ class FanboxReflect(FanboxServiceBase, SubscribeService):
         else:
             raise ValueError(name)
 
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         return []
 
     @classmethod
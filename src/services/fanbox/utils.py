@@ -1,7 +1,6 @@
 import dataclasses
 import shutil
 import tempfile
-import time
 import unittest
 import zipfile
 from typing import List, Optional, Tuple, Iterable
@@ -150,7 +149,8 @@ class FanboxApi:
         data = res.json()
         return self._parse_items(data['body']['items'])
 
-    def _iter_pages(self, start_url, pause_time):
+    def _iter_pages(self, start_url):
+        # Pages are only paced by the rate limit of the session
         next_url = start_url
         while next_url is not None:
             try:
@@ -163,19 +163,18 @@ class FanboxApi:
             if next_url == data['nextUrl']:
                 break
             next_url = data['nextUrl']
-            time.sleep(pause_time)
 
-    def iter_creator_posts(self, artist, limit=20, pause_time=3):
+    def iter_creator_posts(self, artist, limit=20):
         url = f'https://api.fanbox.cc/post.listCreator?creatorId={artist}&limit={limit}'
-        yield from self._iter_pages(url, pause_time)
+        yield from self._iter_pages(url)
 
-    def iter_home(self, limit=20, pause_time=3):
+    def iter_home(self, limit=20):
         url = f'https://api.fanbox.cc/post.listHome?limit={limit}'
-        yield from self._iter_pages(url, pause_time)
+        yield from self._iter_pages(url)
 
-    def iter_supporting(self, limit=20, pause_time=3):
+    def iter_supporting(self, limit=20):
         url = f'https://api.fanbox.cc/post.listSupporting?limit={limit}'
-        yield from self._iter_pages(url, pause_time)
+        yield from self._iter_pages(url)
 
 
 class FanboxTestCase(unittest.TestCase):
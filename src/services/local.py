@@ -1,34 +1,85 @@
 import json
+import os
+import shutil
+import stat
+import uuid
+from contextlib import closing
 from dataclasses import dataclass
-from typing import Iterable, IO
+from typing import Iterable, Callable
 
 from pathlib import Path
 
 from src.data import FullItem
 from src.services import PushService
+from src.utils.blobstore import FILE_MODE
+from src.utils.images import ImageHandle
 
 
 @dataclass
 class LocalConfig:
     root: str = '/external'
+    # Hardlink images from a local image cache on the same filesystem instead of copying them.
+    # The pushed files share their bytes with the cache, they must not be edited in place.
+    link_from_cache: bool = True
 
 
 class LocalService(PushService):
     def __init__(self, config: LocalConfig):
-        self.config = LocalConfig
+        self.config = config
         self.root = Path(config.root)
 
-    def push_item(self, item: FullItem, images: Iterable[IO], channel: str, converted_username: str):
+    @staticmethod
+    def write_atomic(fp: Path, write: Callable[[Path], None]):
+        """
+        Writes a file through a temporary name in the same directory, a crash never leaves a truncated `fp`.
+        """
+        tmp = fp.with_name(f".{fp.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            write(tmp)
+            os.replace(tmp, fp)
+        except BaseException:
+            try:
+                tmp.unlink()
+            except FileNotFoundError:
+                pass
+            raise
+
+    @staticmethod
+    def write_bytes(tmp: Path, data: bytes):
+        with tmp.open('wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_image(self, tmp: Path, image: ImageHandle):
+        if image.path is not None:
+            # Blobs stored before they were given the usual mode would be readable by their owner only
+            if self.config.link_from_cache and stat.S_IMODE(os.stat(image.path).st_mode) == FILE_MODE:
+                try:
+                    os.link(image.path, tmp)
+                    return
+                except OSError:
+                    # The cache is on another filesystem, or it doesn't allow links
+                    pass
+            # Copies in the kernel with sendfile
+            shutil.copyfile(image.path, tmp)
+            with tmp.open('rb') as f:
+                os.fsync(f.fileno())
+            return
+        with closing(image.open()) as src, tmp.open('wb') as f:
+            shutil.copyfileobj(src, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def push_item(self, item: FullItem, images: Iterable[ImageHandle], channel: str, converted_username: str,
+                  attempt: int = 1):
         parent = self.root / item.service.value.replace('/', '_') / converted_username.replace('/', '_')
         parent.mkdir(parents=True, exist_ok=True)
-        meta_file = parent / f"{item.item_id}_info.json"
-        with meta_file.open('w') as f:
-            json.dump(item.to_dict(), f, ensure_ascii=False)
+        meta = json.dumps(item.to_dict(), ensure_ascii=False).encode('utf-8')
+        self.write_atomic(parent / f"{item.item_id}_info.json", lambda tmp: self.write_bytes(tmp, meta))
         if len(item.content) > 100:
-            content_file = parent / f"{item.item_id}_content.txt"
-            with content_file.open('w') as f:
-                f.write(item.content)
-        for idx, buf in enumerate(images):
-            fp = parent / f"{item.item_id}_{idx:03d}.png"
-            with fp.open('wb') as f:
-                f.write(buf.read())
+            content = item.content.encode('utf-8')
+            self.write_atomic(parent / f"{item.item_id}_content.txt", lambda tmp: self.write_bytes(tmp, content))
+        for idx, img in enumerate(images):
+            fp = parent / f"{item.item_id}_{idx:03d}{img.extension}"
+            self.write_atomic(fp, lambda tmp: self.write_image(tmp, img))
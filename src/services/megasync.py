@@ -1,4 +1,6 @@
 import json
+import shutil
+from contextlib import closing
 from dataclasses import dataclass
 from io import BytesIO
 from pathlib import Path
@@ -11,6 +13,7 @@ from src.data import FullItem
 from src.enums import ServiceType
 from src.models.post import PostRecord
 from src.services import PushService
+from src.utils.images import ImageHandle
 
 @dataclass
 class MegaConfig:
@@ -44,12 +47,13 @@ class MegaService(PushService):
 
     def write_file(self, path: Path, buffer: IO):
         with NamedTemporaryFile() as f:
-            f.write(buffer.read())
+            shutil.copyfileobj(buffer, f)
             f.flush()
             folder = self.ensure_dir(path.parent)
             self.client.upload(f.name, folder, str(path.name))
 
-    def push_item(self, item: FullItem, images: Iterable[IO], channel: str, converted_username: str):
+    def push_item(self, item: FullItem, images: Iterable[ImageHandle], channel: str, converted_username: str,
+                  attempt: int = 1):
         d = self.root / item.service.value / item.source_id
         self.ensure_dir(d)
         json_buffer = BytesIO(json.dumps(item.to_dict(), ensure_ascii=False).encode('utf-8'))
@@ -58,8 +62,9 @@ class MegaService(PushService):
         PostRecord.put_record(item.service, item.item_id, ServiceType.Mega, str(json_fp), channel)
 
         for idx, img in enumerate(images):
-            fp = d / f"{item.item_id}_{idx:03d}.png"
-            self.write_file(fp, img)
+            fp = d / f"{item.item_id}_{idx:03d}{img.extension}"
+            with closing(img.open()) as buf:
+                self.write_file(fp, buf)
             PostRecord.put_record(item.service, item.item_id, ServiceType.Mega, str(fp), channel)
 
 
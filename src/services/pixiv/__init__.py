@@ -10,6 +10,7 @@ from src.models.user import UserInfo
 from src.services import SubscribeService, PullService
 from src.services.pixiv.utils import PixivAPI
 from src.utils.network import get_session_from_cookies_file
+from src.utils.ratelimit import rate_limited
 
 
 @dataclass
@@ -21,7 +22,7 @@ class PixivServiceBase:
     config: PixivConfig
     def __init__(self, config: PixivConfig):
         self.config = config
-        self.sess = get_session_from_cookies_file(config.cookies)
+        self.sess = rate_limited(get_session_from_cookies_file(config.cookies), ServiceType.Pixiv)
         self.api = PixivAPI(self.sess)
 
     def get_nickname(self, uid: int):
@@ -65,11 +66,15 @@ class PixivService(PixivServiceBase, PullService):
 
 
 class PixivIllustSubs(PixivServiceBase, SubscribeService):
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
-        for uid in self.api.user_illustrates(int(name)):
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
+        # The profile lists every work at once, newer works have larger ids.
+        id_list = sorted(map(int, self.api.user_illustrates(int(name))), reverse=True)
+        for uid in id_list:
+            if cursor is not None and uid <= int(cursor):
+                break
             yield IndexItem(ServiceType.Pixiv, str(uid))
 
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         return []
 
     @classmethod
@@ -82,11 +87,11 @@ class PixivIllustSubs(PixivServiceBase, SubscribeService):
 
 
 class PixivLikeSubs(PixivServiceBase, SubscribeService):
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
         for uid in self.api.get_bookmarks(int(name), 0, False):
             yield IndexItem(ServiceType.Pixiv, str(uid))
 
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         return []
 
     @classmethod
@@ -99,11 +104,11 @@ class PixivLikeSubs(PixivServiceBase, SubscribeService):
 
 
 class PixivSearchSubs(PixivServiceBase, SubscribeService):
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
         for uid in self.api.search(name.split(' '), 0):
             yield IndexItem(ServiceType.Pixiv, str(uid))
 
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         return []
 
     @classmethod
@@ -117,7 +122,7 @@ class PixivSearchSubs(PixivServiceBase, SubscribeService):
 
 
 class PixivReflect(PixivServiceBase, SubscribeService):
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
         if name == 'following':
             return [
                 IndexItem(service=ServiceType.Pixiv, item_id=str(uid))
@@ -126,7 +131,7 @@ class PixivReflect(PixivServiceBase, SubscribeService):
         else:
             raise ValueError(name)
 
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         return []
 
     @classmethod
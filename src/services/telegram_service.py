@@ -1,16 +1,27 @@
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from io import BytesIO
-from typing import List, IO
+from typing import List, Dict, Optional
 
 import telegram
 from telegram import InputMediaPhoto
+from telegram.error import RetryAfter
 
 from src.data import FullItem
 from src.enums import ServiceType
+from src.models.item import ImageRendition
 from src.models.post import PostRecord
-from src.services.base import PushService
-from PIL import Image
+from src.models.utils import ServiceKVStore
+from src.services.base import PushService, PushDeferred
+from src.utils.images import ImageHandle, RenditionSpec
+from src.utils.ratelimit import get_rate_limiter, TokenBucket, RateLimit
+
+TELEGRAM_HOST = 'api.telegram.org'
+# Photos Telegram accepts in one media group
+MEDIA_GROUP_MAX = 10
+# Telegram scales photos down to 1280px anyway, and only accepts up to 10 MB
+TELEGRAM_PHOTO = RenditionSpec(max_edge=1000, format='JPEG', quality=87, max_bytes=10 * 2 ** 20)
 
 
 @dataclass
@@ -20,6 +31,111 @@ class TelegramConfig:
     media_group_limit: int
     attach_source: bool = False
     simple_notification: bool = False
+    # Messages per second to one chat, Telegram allows about 20 per minute in groups and channels.
+    # A media group counts as one message per photo.
+    chat_rate: float = 1 / 3
+    chat_burst: int = 20
+    # Longer flood waits put the task back in the queue instead of blocking the push lane
+    max_flood_wait: float = 30
+
+
+@dataclass
+class SenderStats:
+    requests: int = 0
+    messages: int = 0
+    flood_waits: int = 0
+    deferred: int = 0
+    # Seconds spent waiting for the send budgets
+    waited: float = 0.0
+    started: float = 0.0
+
+
+class TelegramSender:
+    """
+    Calls the bot API within Telegram's flood limits: a budget for every chat, and the global budget of the
+    bot from the rate limiter. Flood waits are waited out when they are short, and defer the push otherwise.
+    """
+
+    def __init__(self, config: TelegramConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.chats: Dict[str, TokenBucket] = {}
+        self.stats = SenderStats(started=time.monotonic())
+
+    def chat(self, chat_id: str) -> TokenBucket:
+        with self.lock:
+            if chat_id not in self.chats:
+                self.chats[chat_id] = TokenBucket(RateLimit(rate=self.config.chat_rate, burst=self.config.chat_burst))
+            return self.chats[chat_id]
+
+    def defer(self, retry_after: float):
+        with self.lock:
+            self.stats.deferred += 1
+        raise PushDeferred(retry_after)
+
+    def send(self, chat_id: str, func, *args, messages: int = 1, **kwargs):
+        limiter = get_rate_limiter()
+        bucket = self.chat(chat_id)
+        attempt = 0
+        while True:
+            paused = bucket.paused_for()
+            if paused > self.config.max_flood_wait:
+                self.defer(paused)
+            start = time.monotonic()
+            bucket.acquire(messages)
+            limiter.acquire(ServiceType.Telegram, TELEGRAM_HOST)
+            waited = time.monotonic() - start
+            try:
+                result = func(chat_id, *args, **kwargs)
+            except RetryAfter as err:
+                print("Flood control:", chat_id, f"{err.retry_after}s")
+                bucket.pause(err.retry_after)
+                with self.lock:
+                    self.stats.flood_waits += 1
+                    self.stats.waited += waited
+                if err.retry_after > self.config.max_flood_wait or attempt >= limiter.config.max_retries:
+                    self.defer(err.retry_after)
+                attempt += 1
+                continue
+            with self.lock:
+                self.stats.requests += 1
+                self.stats.messages += messages
+                self.stats.waited += waited
+            return result
+
+    def report(self):
+        with self.lock:
+            st = self.stats
+            self.stats = SenderStats(started=time.monotonic())
+        if st.requests == 0 and st.deferred == 0:
+            return
+        elapsed = max(time.monotonic() - st.started, 1e-6)
+        print(f"Telegram: {st.messages} messages in {st.requests} requests, {st.messages / elapsed * 60:.1f} messages/min, "
+              f"{st.waited:.1f}s waiting for budget, {st.flood_waits} flood waits, {st.deferred} deferred")
+
+
+class PostProgress:
+    """
+    The parts of an item already sent to each chat, with their message ids, so a push retried after a flood wait
+    or an error doesn't send them twice. Kept in ServiceKVStore until the item is posted completely.
+    """
+    SERVICE_NAME = 'telegram.post.progress'
+
+    def __init__(self, key: str):
+        self.key = key
+        value = ServiceKVStore.get(self.SERVICE_NAME, key) or {}
+        self.sent: Dict[str, List[str]] = {k: list(v) for k, v in value.get('sent', {}).items()}
+
+    def get(self, part: str, chat_id: str) -> Optional[List[str]]:
+        return self.sent.get(f"{part}:{chat_id}")
+
+    def add(self, part: str, chat_id: str, message_ids: List[str]):
+        self.sent[f"{part}:{chat_id}"] = message_ids
+        ServiceKVStore.put(self.SERVICE_NAME, self.key, {'sent': self.sent})
+
+    def clear(self):
+        if self.sent:
+            ServiceKVStore.delete(self.SERVICE_NAME, self.key)
 
 
 class TelegramServiceBase:
@@ -27,61 +143,91 @@ class TelegramServiceBase:
         self.bot = telegram.Bot(token=config.token)
         self.channels = config.channels
         self.config = config
+        self.sender = TelegramSender(config)
 
-    @staticmethod
-    def resize_image(image_io, edge_limit):
-        img = Image.open(image_io)
-        width, height = img.size
-        max_edge = max(width, height)
-        if max_edge > edge_limit:
-            scale = edge_limit / max_edge
-            width = int(width * scale)
-            height = int(height * scale)
-            if min(width, height) < 5:
-                return None
-            img = img.resize((width, height))
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
-        time.sleep(2)
-        return buf
-
-    def simple_notify(self, url):
+    def progress(self, item: FullItem, channel: str) -> PostProgress:
+        # Several bots may post the same item to the same pipeline channel
+        bot_id = self.config.token.split(':')[0]
+        return PostProgress(f"{bot_id}:{item.service.value}:{item.item_id}:{channel}")
+
+    def simple_notify(self, url, progress: PostProgress):
         for chat_id in self.config.channels:
-            self.bot.send_message(chat_id, f'Done: {url}')
+            if progress.get('notify', chat_id) is None:
+                message = self.sender.send(chat_id, self.bot.send_message, f'Done: {url}')
+                progress.add('notify', chat_id, [str(message.message_id)])
 
-    def post_images(self, images: List[IO], source: str):
-        media = [
-            self.resize_image(i, 1000)
-            for i in images
-        ]
-        media = [
-            InputMediaPhoto(i)
-            for i in media
-            if i is not None
+    def prepare_media(self, images: List[ImageHandle]) -> List[InputMediaPhoto]:
+        media = []
+        for i in images:
+            photo = ImageRendition.render(i, TELEGRAM_PHOTO)
+            if photo is not None:
+                media.append(InputMediaPhoto(photo.read()))
+        return media
+
+    def post_images(self, images: List[ImageHandle], source: str, progress: PostProgress):
+        """
+        Sends every image, in media groups of at most `media_group_limit` photos.
+        The next group is resized in the background while the current one is uploading.
+        Groups that `progress` has for a chat are not sent to it again, and groups sent to every chat aren't resized.
+        """
+        group_size = max(1, min(self.config.media_group_limit, MEDIA_GROUP_MAX))
+        groups = [images[i:i + group_size] for i in range(0, len(images), group_size)]
+        todo = [
+            idx for idx in range(len(groups))
+            if any(progress.get(str(idx), ch) is None for ch in self.channels)
         ]
-        if self.config.attach_source and len(media) > 0:
-            media[0].caption = source
         message_id = []
-        for ch in self.channels:
-            chat = self.bot.get_chat(ch)
-            messages = chat.send_media_group(media)
-            message_id.extend([str(m.message_id) for m in messages])
-        time.sleep(5)
+        with ThreadPoolExecutor(max_workers=1) as resizer:
+            pending = {}
+            if todo:
+                pending[todo[0]] = resizer.submit(self.prepare_media, groups[todo[0]])
+            for idx in range(len(groups)):
+                media = pending[idx].result() if idx in pending else []
+                later = [i for i in todo if i > idx]
+                if later and later[0] not in pending:
+                    pending[later[0]] = resizer.submit(self.prepare_media, groups[later[0]])
+                # Only the first group that is sent gets the caption, it may have been sent by an earlier attempt
+                if media and self.config.attach_source and not message_id:
+                    media[0].caption = source
+                for ch in self.channels:
+                    sent = progress.get(str(idx), ch)
+                    if sent is None and media:
+                        messages = self.sender.send(ch, self.bot.send_media_group, media, messages=len(media))
+                        sent = [str(m.message_id) for m in messages]
+                        progress.add(str(idx), ch, sent)
+                        # The other channels send the photos Telegram already has instead of uploading them again
+                        media = self.reuse_uploads(media, messages)
+                    message_id.extend(sent or [])
         return message_id
 
+    @staticmethod
+    def reuse_uploads(media: List[InputMediaPhoto], messages: List[telegram.Message]) -> List[InputMediaPhoto]:
+        if len(messages) != len(media) or not all(m.photo for m in messages):
+            return media
+        return [
+            InputMediaPhoto(m.photo[-1].file_id, caption=getattr(i, 'caption', None))
+            for i, m in zip(media, messages)
+        ]
+
 
 class TelegramService(PushService, TelegramServiceBase):
-    def push_item(self, item: FullItem, images: List[IO], channel: str, converted_username: str):
+    def push_item(self, item: FullItem, images: List[ImageHandle], channel: str, converted_username: str,
+                  attempt: int = 1):
+        progress = self.progress(item, channel)
         if self.config.simple_notification:
-            self.simple_notify(item.url)
-            return
-
-        id_list = self.post_images(images[:10], item.url)
-        for mid in id_list:
-            PostRecord.put_record(item.service, item.item_id, ServiceType.Telegram, mid, channel)
-        time.sleep(15)
+            self.simple_notify(item.url, progress)
+        else:
+            id_list = self.post_images(images, item.url, progress)
+            PostRecord.put_records(item.service, item.item_id, ServiceType.Telegram, id_list, channel)
+        progress.clear()
 
     @staticmethod
     def push_limit():
         return 3
+
+    @classmethod
+    def renditions(cls) -> List[RenditionSpec]:
+        return [TELEGRAM_PHOTO]
+
+    def report(self):
+        self.sender.report()
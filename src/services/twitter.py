@@ -14,6 +14,7 @@ from src.errors import FetchFailureError
 from src.models.subscribe import MissingSubs
 from src.models.user import UserInfo, UserRel
 from src.services.base import PullService, SubscribeService
+from src.utils.ratelimit import rate_limited
 import tweepy
 
 
@@ -40,7 +41,8 @@ class TweeterServiceBase:
         auth = tweepy.OAuthHandler(config.consumer_key, config.consumer_secret)
         auth.set_access_token(config.access_key, config.access_secret)
 
-        self.api = tweepy.API(auth)
+        self.api = tweepy.API(auth, wait_on_rate_limit=True)
+        self.sess = rate_limited(requests.session(), ServiceType.Twitter)
 
     def get_status(self, sid) -> Optional[TwitterItem]:
         try:
@@ -52,8 +54,8 @@ class TweeterServiceBase:
         else:
             return status2item(status)
 
-    def get_user_tweets(self, username) -> Iterable[TwitterItem]:
-        l: Iterable[tweepy.Status] = self.api.user_timeline(username, count=20)
+    def get_user_tweets(self, username, since_id: Optional[str] = None) -> Iterable[TwitterItem]:
+        l: Iterable[tweepy.Status] = self.api.user_timeline(username, count=20, since_id=since_id)
         for s in l:
             yield status2item(s)
 
@@ -78,7 +80,7 @@ class TwitterService(TweeterServiceBase, PullService):
 
     def download_item_image(self, item: FullItem, url: str) -> IO:
         try:
-            res = requests.get(url)
+            res = self.sess.get(url)
         except RequestException as err:
             raise FetchFailureError(str(err)) from err
         else:
@@ -95,12 +97,12 @@ class TwitterUsernameSubs(TweeterServiceBase, SubscribeService):
     def get_url(cls, name: str) -> Optional[str]:
         return f"https://twitter.com/{name}"
 
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
         return []
 
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         try:
-            tweets = list(self.get_user_tweets(name))
+            tweets = list(self.get_user_tweets(name, since_id=cursor))
         except TweepError as err:
             MissingSubs.report(ServiceType.Twitter, 'username', name, err.reason)
             print("MISSING SUBS", 'twitter', 'username', name, err.reason)
@@ -123,10 +125,10 @@ class TwitterLikeSubs(TweeterServiceBase, SubscribeService):
     def get_url(cls, name: str) -> Optional[str]:
         return f"https://twitter.com/{name}/likes"
 
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
         return []
 
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         try:
             tweets = list(self.get_user_likes(name))
         except TweepError as err:
@@ -1,13 +1,18 @@
 import json
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from dataclasses import dataclass
-from functools import lru_cache
+from functools import lru_cache, partial
 from io import BytesIO
-from tempfile import TemporaryFile, NamedTemporaryFile
-from typing import Iterable, IO
+from posixpath import basename
+from typing import Iterable, IO, Iterator, Dict, Set, Optional
 
+import requests
 import webdav3
-from webdav3.client import Client
+from requests.adapters import HTTPAdapter
+from webdav3.client import Client, WebDavXmlUtils
+from webdav3.urn import Urn
 
 from src.data import FullItem
 from src.enums import ServiceType
@@ -15,6 +20,7 @@ from src.models.post import PostRecord
 from src.models.user import UserInfo
 from src.models.utils import ServiceKVStore
 from src.services.base import PushService
+from src.utils.images import ImageHandle
 import webdav3.exceptions
 
 
@@ -28,9 +34,43 @@ class WebDavConfig:
     path: str
     root_dir: str
     force_direct: bool = False
+    # Bytes read from the cache per chunk of a streamed upload
+    upload_chunk_size: int = 2 ** 20
+    # Uploads running at the same time, over as many kept-alive connections
+    max_connections: int = 5
 
 SERVICE_NAME='webdav.post.service'
 
+
+class KnownDirs:
+    """
+    Remote directories known to exist, shared by the WebDAV services of the process.
+    Loaded from ServiceKVStore with one query the first time it is used, and written through to it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs: Optional[Dict[str, Set[str]]] = None
+
+    def load(self) -> Dict[str, Set[str]]:
+        with self.lock:
+            if self.dirs is None:
+                self.dirs = ServiceKVStore.keys(SERVICE_NAME)
+            return self.dirs
+
+    def __contains__(self, key) -> bool:
+        service_name, path = key
+        return path in self.load().get(service_name, ())
+
+    def add(self, service_name: str, path: str):
+        ServiceKVStore.put(service_name, path, {})
+        dirs = self.load()
+        with self.lock:
+            dirs.setdefault(service_name, set()).add(path)
+
+
+known_dirs = KnownDirs()
+
 class WebDavServiceBase:
     def __init__(self, conf: WebDavConfig):
         url = f"http{'s' if conf.use_https else ''}://{conf.host}:{conf.port}{conf.path}{conf.root_dir}"
@@ -43,7 +83,12 @@ class WebDavServiceBase:
         self.client = Client(options)
         if conf.force_direct:
             self.client.session.proxies = {}
-        self.sem = threading.Semaphore(5)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=conf.max_connections)
+        self.client.session.mount('http://', adapter)
+        self.client.session.mount('https://', adapter)
+        self.max_connections = conf.max_connections
+        self.sem = threading.Semaphore(conf.max_connections)
+        self.chunk_size = conf.upload_chunk_size
 
     def dir_exists(self, path: str):
         try:
@@ -55,41 +100,75 @@ class WebDavServiceBase:
 
     def ensure_dir(self, tag: str, path: str):
         service_name = f"{SERVICE_NAME}:{tag}"
-        if ServiceKVStore.exists(service_name, path):
-            return
-        if self.dir_exists(path):
-            ServiceKVStore.put(service_name, path, {})
+        if (service_name, path) in known_dirs:
             return
-        self.client.mkdir(path)
-        ServiceKVStore.put(service_name, path, {})
+        if not self.dir_exists(path):
+            self.client.mkdir(path)
+        known_dirs.add(service_name, path)
+
+    def remote_files(self, path: str) -> Dict[str, Optional[int]]:
+        """
+        Sizes of the files in a remote directory by name, from a single PROPFIND.
+        `Client.list` checks that the directory exists with another request first, a 404 tells us the same.
+        """
+        urn = Urn(path, directory=True)
+        try:
+            response = self.request('list', urn.quote())
+        except webdav3.exceptions.RemoteResourceNotFound:
+            return {}
+        result = {}
+        for info in WebDavXmlUtils.parse_get_list_info_response(response.content):
+            if info['isdir']:
+                continue
+            size = info.get('size')
+            result[basename(info['path'])] = int(size) if size is not None else None
+        return result
+
+    def read_chunks(self, buffer: IO) -> Iterator[bytes]:
+        return iter(partial(buffer.read, self.chunk_size), b'')
+
+    def request(self, action: str, path: str, data=None) -> requests.Response:
+        response = self.client.execute_request(action=action, path=path, data=data)
+        # Responses are streamed, the connection only goes back to the pool once the body is read
+        response.content
+        return response
+
+    def upload(self, fp: str, buffer: IO):
+        """
+        Streams the buffer as the body of a PUT with chunked transfer encoding, nothing is written to local disk.
+        """
+        self.request('upload', Urn(fp).quote(), self.read_chunks(buffer))
 
     def write_file(self, tag: str, service: ServiceType, dir_name: str, filename: str, buffer: IO):
         with self.sem:
             self.ensure_dir(tag, service.value)
             self.ensure_dir(tag, f"{service.value}/{dir_name}")
             fp = f"{service.value}/{dir_name}/{filename}"
-            with NamedTemporaryFile() as f:
-                f.write(buffer.read())
-                f.flush()
-                try:
-                    self.client.upload(fp, f.name)
-                except webdav3.exceptions.RemoteParentNotFound as err:
-                    print(err)
-                    pp = f"{service.value}/{dir_name}"
-                    # assert not ServiceKVStore.exists(SERVICE_NAME, pp)
-                    # self.client.mkdir(pp)
-                    from webdav3.urn import Urn
-                    directory_urn = Urn(pp, directory=True)
-                    response = self.client.execute_request(action='mkdir', path=directory_urn.quote())
-                    assert response in (200, 201), response
-
-                    ServiceKVStore.put(SERVICE_NAME, pp, {})
-                    self.client.upload(fp, f.name)
+            try:
+                self.upload(fp, buffer)
+            except (webdav3.exceptions.RemoteResourceNotFound, webdav3.exceptions.ResponseErrorCode) as err:
+                # Servers answer 409 Conflict, or sometimes 404, when the parent directory is missing
+                if isinstance(err, webdav3.exceptions.ResponseErrorCode) and err.code != 409:
+                    raise
+                print(err)
+                pp = f"{service.value}/{dir_name}"
+                directory_urn = Urn(pp, directory=True)
+                response = self.request('mkdir', directory_urn.quote())
+                assert response.status_code in (200, 201), response
+
+                known_dirs.add(f"{SERVICE_NAME}:{tag}", pp)
+                buffer.seek(0)
+                self.upload(fp, buffer)
             return fp
 
+    def write_image(self, tag: str, service: ServiceType, dir_name: str, filename: str, image: ImageHandle):
+        with closing(image.open()) as buf:
+            return self.write_file(tag, service, dir_name, filename, buf)
+
 
 class WebDavService(PushService, WebDavServiceBase):
-    def push_item(self, item: FullItem, images: Iterable[IO], channel: str, converted_username: str):
+    def push_item(self, item: FullItem, images: Iterable[ImageHandle], channel: str, converted_username: str,
+                  attempt: int = 1):
         json_buffer = BytesIO(json.dumps(item.to_dict(), ensure_ascii=False).encode('utf-8'))
         # nickname = UserInfo.get_nickname(item.service, item.source_id)
         # if nickname is None:
@@ -97,9 +176,31 @@ class WebDavService(PushService, WebDavServiceBase):
         # else:
         #     dir_name = f"{nickname}({item.source_id})"
         dir_name = item.source_id
-        fp = self.write_file(channel, item.service, dir_name, f"{item.item_id}_info.json", json_buffer)
-        PostRecord.put_record(item.service, item.item_id, ServiceType.WebDav, fp, channel)
+        # Files left by an earlier attempt that failed midway are not sent again.
+        # The directory holds every item of the source, it is only listed when there was an earlier attempt.
+        remote = self.remote_files(f"{item.service.value}/{dir_name}") if attempt > 1 else {}
+        files = []
+        skipped = 0
+
+        json_name = f"{item.item_id}_info.json"
+        if remote.get(json_name) == len(json_buffer.getvalue()):
+            files.append(f"{item.service.value}/{dir_name}/{json_name}")
+            skipped += 1
+        else:
+            files.append(self.write_file(channel, item.service, dir_name, json_name, json_buffer))
 
-        for idx, img in enumerate(images):
-            fp = self.write_file(channel, item.service, dir_name, f"{item.item_id}_{idx:03d}.png", img)
-            PostRecord.put_record(item.service, item.item_id, ServiceType.WebDav, fp, channel)
+        # The semaphore caps the uploads of all items pushed to this server, not just this one
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            # Remote paths of skipped files, futures of uploads
+            results = []
+            for idx, img in enumerate(images):
+                filename = f"{item.item_id}_{idx:03d}{img.extension}"
+                if img.size is not None and remote.get(filename) == img.size:
+                    results.append(f"{item.service.value}/{dir_name}/{filename}")
+                    skipped += 1
+                else:
+                    results.append(executor.submit(self.write_image, channel, item.service, dir_name, filename, img))
+            files.extend(r if isinstance(r, str) else r.result() for r in results)
+        if skipped:
+            print(f"WebDAV: {skipped} files of {item.service.value}/{item.item_id} are already uploaded")
+        PostRecord.put_records(item.service, item.item_id, ServiceType.WebDav, files, channel)
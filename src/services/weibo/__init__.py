@@ -12,6 +12,7 @@ from src.models.user import UserInfo
 from src.services import PullService, SubscribeService
 from src.services.weibo.utils import WeiboAPI, WeiboItem
 from src.utils.network import get_session_from_cookies_file
+from src.utils.ratelimit import rate_limited
 
 
 @dataclasses.dataclass
@@ -22,7 +23,7 @@ class WeiboConfig:
 class WeiboServiceBase:
     def __init__(self, config: WeiboConfig):
         self.config = config
-        self.sess = get_session_from_cookies_file(config.cookies)
+        self.sess = rate_limited(get_session_from_cookies_file(config.cookies), ServiceType.Weibo)
         self.api = WeiboAPI(self.sess, config.cookies + '.pkl')
 
     @staticmethod
@@ -66,10 +67,10 @@ class WeiboService(WeiboServiceBase, PullService):
 
 
 class WeiboReflect(WeiboServiceBase, SubscribeService):
-    def subscribe_index(self, name: str) -> Iterable[IndexItem]:
+    def subscribe_index(self, name: str, cursor: Optional[str] = None) -> Iterable[IndexItem]:
         return []
 
-    def subscribe_full(self, name: str) -> Iterable[FullItem]:
+    def subscribe_full(self, name: str, cursor: Optional[str] = None) -> Iterable[FullItem]:
         if name == 'like':
             user_id = self.api.get_user_id()
             results = self.api.get_like_list(user_id, 0)
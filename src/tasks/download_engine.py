@@ -0,0 +1,222 @@
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, Future
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Callable, Dict, List, Tuple, Any, Set
+from urllib.parse import urlparse
+
+from src.config import RootConfig
+from src.data import FullItem
+from src.enums import ServiceType, TaskStage, TaskStatus
+from src.models.item import ItemInfo, ImageRendition
+from src.services import PullService, push_services
+from src.utils.images import normalize_image, render_image, RenditionSpec
+
+
+@dataclass
+class DownloadState:
+    item: FullItem
+    # Renditions the push targets of the item will send
+    specs: List[RenditionSpec] = field(default_factory=list)
+    # Images, attachment archives and renditions that aren't in the cache yet
+    remaining: int = 0
+    failed: bool = False
+    finished: bool = False
+
+
+@dataclass
+class DownloadStats:
+    items: int = 0
+    failed: int = 0
+    images: int = 0
+    renditions: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+
+
+class DownloadEngine:
+    """
+    Downloads the images of many items at once.
+    Network fetches run on a thread pool under a connection limit per host, image checks and transcoding run on
+    a process pool, and every image is written to the cache as soon as it is ready.
+    The renditions the push targets need are rendered on the same process pool, so posting only reads the cache.
+    """
+
+    def __init__(self, config: RootConfig, get_service: Callable[[ServiceType], PullService]):
+        self.config = config
+        self.limit = config.limit
+        self.get_service = get_service
+        self.host_lock = threading.Lock()
+        self.host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self.rendering: Set[Tuple[str, RenditionSpec]] = set()
+        # Archive members sent to the encoders by the fetch threads, picked up by the main loop
+        self.arrivals: queue.Queue = queue.Queue()
+        # Bounds the members extracted but not saved yet, so a large archive isn't held in memory at once
+        self.member_slots = threading.Semaphore(max(self.limit.download_workers, 1))
+
+    def host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).hostname
+        with self.host_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.limit.download_host_connections)
+            return self.host_semaphores[host]
+
+    def fetch_image(self, service: PullService, item: FullItem, url: str) -> bytes:
+        with self.host_semaphore(url):
+            print(url)
+            return service.download_item_image(item, url).read()
+
+    def fetch_attachments(self, encoders: ProcessPoolExecutor, service: PullService, item: FullItem):
+        """
+        Sends every archive member to the encoders as soon as it is extracted.
+        Members come from one stream, they have to be read in order.
+        """
+        key = (item.service, item.item_id)
+        idx = 0
+        for att_url in item.attachment_urls:
+            with self.host_semaphore(att_url):
+                for zf in service.extract_attachments(item, att_url):
+                    self.member_slots.acquire()
+                    raw = zf.read()
+                    self.arrivals.put((encoders.submit(normalize_image, raw), key, idx, len(raw)))
+                    idx += 1
+
+    def rendition_specs(self, channels: List[str]) -> List[RenditionSpec]:
+        specs = []
+        for ch in channels:
+            pipeline = self.config.pipeline.get(ch)
+            if pipeline is None:
+                continue
+            for push in pipeline.push:
+                if push.service in push_services:
+                    specs.extend(s for s in push_services[push.service].renditions() if s not in specs)
+        return specs
+
+    def render(self, encoders: ProcessPoolExecutor, pending: Dict[Future, Any], st: DownloadState, sha256: str,
+               data: bytes):
+        key = (st.item.service, st.item.item_id)
+        for spec in st.specs:
+            # The same image may be in several items of the batch
+            if (sha256, spec) in self.rendering or ImageRendition.exists(sha256, spec):
+                continue
+            self.rendering.add((sha256, spec))
+            pending[encoders.submit(render_image, data, spec)] = (key, 'rendition', (sha256, spec))
+            st.remaining += 1
+
+    def run(self, items: List[FullItem]) -> DownloadStats:
+        stats = DownloadStats()
+        states: Dict[Tuple[ServiceType, str], DownloadState] = {}
+        pending: Dict[Future, Tuple[Tuple[ServiceType, str], str, Any]] = {}
+        start = time.monotonic()
+        channels = ItemInfo.get_channels_of((item.service, item.item_id) for item in items)
+        with ThreadPoolExecutor(max_workers=self.limit.download_workers) as fetchers, \
+                ProcessPoolExecutor(max_workers=self.limit.encode_processes or None) as encoders:
+            for item in items:
+                key = (item.service, item.item_id)
+                st = states[key] = DownloadState(item=item, specs=self.rendition_specs(channels.get(key, [])))
+                try:
+                    service = self.get_service(item.service)
+                except Exception:
+                    traceback.print_exc()
+                    st.failed = True
+                    self.finish(st, stats)
+                    continue
+                for url in item.image_urls:
+                    pending[fetchers.submit(self.fetch_image, service, item, url)] = (key, 'image', url)
+                    st.remaining += 1
+                if item.attachment_urls:
+                    pending[fetchers.submit(self.fetch_attachments, encoders, service, item)] = (key, 'attachments', None)
+                    st.remaining += 1
+                if st.remaining == 0:
+                    self.finish(st, stats)
+
+            while pending:
+                self.collect_arrivals(pending, states, stats)
+                # Archive members arrive while their fetch is running, which nothing else would wake us up for
+                extracting = any(kind == 'attachments' for _, kind, _ in pending.values())
+                done, _ = wait(list(pending), timeout=0.2 if extracting else None, return_when=FIRST_COMPLETED)
+                # Members queued before their fetch finished are counted before the fetch is
+                self.collect_arrivals(pending, states, stats)
+                for fut in done:
+                    key, kind, arg = pending.pop(fut)
+                    if kind == 'save_attachment':
+                        self.member_slots.release()
+                    st = states[key]
+                    if st.finished:
+                        continue
+                    if kind == 'rendition':
+                        # Posting renders the image itself when this fails
+                        st.remaining -= 1
+                        try:
+                            data = fut.result()
+                            if data is not None:
+                                ImageRendition.put(arg[0], arg[1], data)
+                                stats.renditions += 1
+                        except Exception:
+                            traceback.print_exc()
+                        if st.remaining == 0:
+                            self.finish(st, stats)
+                        continue
+                    try:
+                        result = fut.result()
+                        if kind == 'image':
+                            stats.bytes_in += len(result)
+                            pending[encoders.submit(normalize_image, result)] = (key, 'save_image', arg)
+                        elif kind == 'attachments':
+                            # Its members were counted as they arrived
+                            st.remaining -= 1
+                        elif kind == 'save_image':
+                            data, content_type = result
+                            sha256 = ItemInfo.save_image(st.item, arg, BytesIO(data), content_type)
+                            self.render(encoders, pending, st, sha256, data)
+                            st.remaining -= 1
+                            stats.images += 1
+                            stats.bytes_out += len(data)
+                        elif kind == 'save_attachment':
+                            data, content_type = result
+                            sha256 = ItemInfo.save_attachment_image(st.item, arg, BytesIO(data), content_type)
+                            self.render(encoders, pending, st, sha256, data)
+                            st.remaining -= 1
+                            stats.images += 1
+                            stats.bytes_out += len(data)
+                    except Exception:
+                        traceback.print_exc()
+                        st.failed = True
+                    if st.failed or st.remaining == 0:
+                        self.finish(st, stats)
+        self.report(stats, time.monotonic() - start)
+        return stats
+
+    def collect_arrivals(self, pending: Dict[Future, Any], states: Dict[Tuple[ServiceType, str], DownloadState],
+                         stats: DownloadStats):
+        while True:
+            try:
+                fut, key, idx, size = self.arrivals.get_nowait()
+            except queue.Empty:
+                return
+            pending[fut] = (key, 'save_attachment', idx)
+            states[key].remaining += 1
+            stats.bytes_in += size
+
+    @staticmethod
+    def finish(st: DownloadState, stats: DownloadStats):
+        st.finished = True
+        item = st.item
+        if st.failed:
+            stats.failed += 1
+            ItemInfo.set_status(item.service, item.item_id, TaskStage.Downloading, TaskStatus.Queued)
+        else:
+            stats.items += 1
+            ItemInfo.set_status(item.service, item.item_id, TaskStage.Posting, TaskStatus.Queued)
+
+    @staticmethod
+    def report(stats: DownloadStats, elapsed: float):
+        elapsed = max(elapsed, 1e-6)
+        mb_in = stats.bytes_in / 2 ** 20
+        mb_out = stats.bytes_out / 2 ** 20
+        print(f"Downloaded {stats.items} items ({stats.failed} failed), {stats.images} images and "
+              f"{stats.renditions} renditions in {elapsed:.1f}s: "
+              f"{stats.items / elapsed:.2f} items/s, {mb_in / elapsed:.2f} MB/s in, {mb_out / elapsed:.2f} MB/s to cache")
@@ -0,0 +1,203 @@
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from src.config import RootConfig, LaneConfig
+from src.data import FullItem
+from src.enums import ServiceType, TaskStage, TaskStatus
+from src.models.item import ItemInfo, SecondaryTask
+from src.services import PushService, PushDeferred, pull_services
+from src.utils.images import ImageHandle
+from src.utils.ratelimit import TokenBucket, RateLimit
+from src.utils.worker import get_worker_id
+
+
+@dataclass
+class LaneStats:
+    items: int = 0
+    pushed: int = 0
+    failed: int = 0
+    deferred: int = 0
+    elapsed: float = 0.0
+
+
+class SharedImages:
+    """
+    The images of the items posted in one run, shared by every lane.
+    Items that go to several targets or channels are read from the cache once, into a local directory
+    which is deleted at the end of the run. The other items are opened straight from the cache.
+    """
+
+    def __init__(self, root: Path, fanout: Set[Tuple[ServiceType, str]]):
+        self.root = root
+        self.fanout = fanout
+        self.lock = threading.Lock()
+        self.locks: Dict[Tuple[ServiceType, str], threading.Lock] = {}
+        self.images: Dict[Tuple[ServiceType, str], List[ImageHandle]] = {}
+
+    def get(self, item: FullItem) -> List[ImageHandle]:
+        key = (item.service, item.item_id)
+        if key not in self.fanout:
+            return self.load(item)
+        with self.lock:
+            item_lock = self.locks.setdefault(key, threading.Lock())
+        with item_lock:
+            if key not in self.images:
+                images = self.load(item)
+                path = self.root / item.service.value / item.item_id.replace('/', '_')
+                path.mkdir(parents=True, exist_ok=True)
+                self.images[key] = [img.pin(path / str(idx)) for idx, img in enumerate(images)]
+            return self.images[key]
+
+    @staticmethod
+    def load(item: FullItem) -> List[ImageHandle]:
+        images = ItemInfo.get_images(item)
+        if item.attachment_urls:
+            images.extend(ItemInfo.get_attachment_images(item))
+        return images
+
+
+class PushLane:
+    """
+    Posts the tasks of one push target, `workers` items at a time and under the rate limit of the lane.
+    """
+
+    def __init__(self, post_service: ServiceType, post_conf: str, config: LaneConfig, client: PushService):
+        self.post_service = post_service
+        self.post_conf = post_conf
+        self.config = config
+        self.client = client
+        self.bucket = config.rate and TokenBucket(RateLimit(rate=config.rate, burst=config.burst))
+        self.lock = threading.Lock()
+        self.stats = LaneStats()
+
+    @property
+    def name(self) -> str:
+        return f"{self.post_service.value}:{self.post_conf}"
+
+    def run(self, images: SharedImages):
+        """
+        Claims and posts batches of items until the queue of the target is empty or the time budget is spent.
+        An item is claimed once per run, tasks that failed or were deferred wait for the next run.
+        """
+        start = time.monotonic()
+        touched = set()
+        with ThreadPoolExecutor(max_workers=self.config.workers) as executor:
+            while time.monotonic() - start < self.config.budget:
+                claimed = SecondaryTask.claim_items(
+                    self.config.batch, get_worker_id(), self.post_service, self.post_conf, exclude=touched
+                )
+                if not claimed:
+                    break
+                touched |= set(claimed)
+                items = ItemInfo.get_items(list(claimed))
+                futures = [
+                    executor.submit(self.post_item, images, items.get(key), key, tasks)
+                    for key, tasks in claimed.items()
+                ]
+                wait(futures)
+        self.stats.elapsed = time.monotonic() - start
+
+    def post_item(self, images: SharedImages, item: Optional[FullItem], key: Tuple[ServiceType, str],
+                  tasks: List[SecondaryTask]):
+        stype, item_id = key
+        if item is None:
+            print("Missing item:", stype, item_id)
+            for t in tasks:
+                SecondaryTask.close_task(stype, item_id, t.post_service, t.post_conf, t.channel)
+            return
+        remaining = list(tasks)
+        try:
+            item_images = images.get(item)
+            converted_username = pull_services[item.service].convert_username(item.source_id)
+            while remaining:
+                self.post_task(item, item_images, remaining[0], converted_username)
+                remaining.pop(0)
+        except Exception:
+            traceback.print_exc()
+            for t in remaining:
+                SecondaryTask.release_task(stype, item_id, t.post_service, t.post_conf, t.channel)
+        with self.lock:
+            self.stats.items += 1
+        # Lanes finish the tasks of an item in any order, the last one moves it on
+        if SecondaryTask.task_done(stype, item_id):
+            print("Post Done", key)
+            ItemInfo.set_status(stype, item_id, TaskStage.Cleaning, TaskStatus.Queued)
+
+    def post_task(self, item: FullItem, images, t: SecondaryTask, converted_username: str):
+        print((item.service.value, item.item_id), '=>', (self.post_service.value, self.post_conf))
+        if t.poll_counter >= self.client.push_limit():
+            print("Failed to push item.")
+            SecondaryTask.close_task(item.service, item.item_id, t.post_service, t.post_conf, t.channel)
+            return
+        if self.bucket:
+            self.bucket.acquire()
+        try:
+            self.client.push_item(item, images, t.channel, converted_username, attempt=t.poll_counter)
+        except PushDeferred as err:
+            print("Push deferred:", (item.service.value, item.item_id), self.name, err)
+            SecondaryTask.defer_task(item.service, item.item_id, t.post_service, t.post_conf, t.channel)
+            with self.lock:
+                self.stats.deferred += 1
+        except Exception:
+            traceback.print_exc()
+            SecondaryTask.release_task(item.service, item.item_id, t.post_service, t.post_conf, t.channel)
+            with self.lock:
+                self.stats.failed += 1
+        else:
+            SecondaryTask.close_task(item.service, item.item_id, t.post_service, t.post_conf, t.channel)
+            with self.lock:
+                self.stats.pushed += 1
+
+
+class PushEngine:
+    """
+    Runs one lane per push target in parallel, a slow target only delays its own tasks.
+    Items move on to cleaning as soon as their last task is finished.
+    """
+
+    def __init__(self, config: RootConfig, get_service: Callable[[ServiceType, str], PushService]):
+        self.lanes: List[PushLane] = []
+        targets = {
+            (push.service, push.config)
+            for pipeline in config.pipeline.values()
+            for push in pipeline.push
+        }
+        for stype, conf in sorted(targets, key=lambda t: (t[0].value, t[1])):
+            if conf not in config.api.get(stype, {}):
+                continue
+            try:
+                client = get_service(stype, conf)
+            except Exception:
+                traceback.print_exc()
+                continue
+            self.lanes.append(PushLane(stype, conf, config.lane(stype, conf), client))
+
+    def run(self):
+        if self.lanes:
+            with TemporaryDirectory(prefix='octo-') as tmp:
+                images = SharedImages(Path(tmp), SecondaryTask.fanout_items())
+                with ThreadPoolExecutor(max_workers=len(self.lanes)) as executor:
+                    wait([executor.submit(self.run_lane, lane, images) for lane in self.lanes])
+        self.report()
+
+    @staticmethod
+    def run_lane(lane: PushLane, images: SharedImages):
+        try:
+            lane.run(images)
+        except Exception:
+            traceback.print_exc()
+
+    def report(self):
+        for lane in self.lanes:
+            st = lane.stats
+            lane.client.report()
+            if st.items == 0:
+                continue
+            print(f"Lane {lane.name}: {st.items} items, {st.pushed} pushed, {st.failed} failed, "
+                  f"{st.deferred} deferred in {st.elapsed:.1f}s")
@@ -6,21 +6,28 @@ from src.config import load_config
 from src.data import IndexItem
 from src.enums import ServiceType, TaskStage, TaskStatus
 from src.models.connect import connect_db
-from src.models.item import ItemInfo
+from src.models.item import ItemInfo, summarize_status
 from src.models.subscribe import SubscribeSource
 from src.models.user import UserInfo
 from src.services import subscribe_services, pull_services, PullService
+from src.utils.cache import ttl_cache
 
 template_folder = str(Path(__file__).parent.parent / 'templates')
 
 app = Flask(__name__, template_folder=template_folder)
 
 
+@ttl_cache(load_config().server.stats_ttl)
+def queue_status():
+    return ItemInfo.status_matrix()
+
+
 @app.route("/")
 def _index():
     pipelines = load_config().pipeline.items()
-    status = ItemInfo.count_status()
-    return render_template('index.jinja2', pipelines=pipelines, status=status)
+    status = queue_status()
+    return render_template('index.jinja2', pipelines=pipelines, status=status['total'],
+                           service_status=status['services'])
 
 
 @app.route("/pipeline/<pipeline_name>")
@@ -35,7 +42,7 @@ def _pipeline(pipeline_name):
         subss = subscribe_services[s.service]
         options = subss.options()
         subs.append((s.service[0].value, s.service[1], l, len(l), options))
-    status = ItemInfo.count_status()
+    status = queue_status()['pipelines'].get(pipeline_name, summarize_status({}))
     return render_template('pipeline.jinja2',
                            pipeline_name=pipeline_name,
                            subs=subs,
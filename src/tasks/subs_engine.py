@@ -0,0 +1,220 @@
+import random
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Optional, Iterable, Dict, Tuple, TypeVar
+
+from src.config import RootConfig, LimitConfig
+from src.data import IndexItem, FullItem
+from src.enums import ServiceType, TaskStage, TaskStatus
+from src.models.item import ItemInfo
+from src.models.subscribe import SubscribeSource
+from src.services import subscribe_services, SubscribeService
+
+T = TypeVar('T')
+
+
+@dataclass
+class SubsJob:
+    stype: ServiceType
+    sfunc: str
+    name: str
+    channels: List[str]
+    cursor: Optional[str] = None
+    last_poll_at: Optional[datetime] = None
+    poll_interval: Optional[int] = None
+    yield_rate: Optional[float] = None
+
+
+@dataclass
+class SubsResult:
+    job: SubsJob
+    seen: int = 0
+    new: int = 0
+    elapsed: float = 0.0
+    error: Optional[str] = None
+    timed_out: bool = False
+
+
+class SubsTimeout(Exception):
+    pass
+
+
+class SubscriptionEngine:
+    """
+    Polls the subscriptions that are due, and schedules their next poll.
+    Every service type has its own thread pool sized to its concurrency cap, so a slow site only holds back
+    its own subscriptions.
+    """
+
+    def __init__(self, config: RootConfig):
+        self.config = config
+        self.limit = config.limit
+        self.services: Dict[Tuple[ServiceType, str], SubscribeService] = {}
+        self.caps: Dict[ServiceType, int] = {}
+        for (stype, sfunc), service_type in subscribe_services.items():
+            if stype not in config.api:
+                continue
+            service_conf = list(config.api[stype].values())[0]
+            try:
+                self.services[(stype, sfunc)] = service_type(service_conf)
+            except Exception:
+                traceback.print_exc()
+                continue
+            self.caps[stype] = min(self.limit.subscribe_cap(stype), self.limit.subscribe_workers)
+
+    def jobs(self) -> List[SubsJob]:
+        now = datetime.utcnow()
+        return [
+            SubsJob(stype=stype, sfunc=sfunc, name=src.name, channels=channels, cursor=src.cursor,
+                    last_poll_at=src.last_poll_at, poll_interval=src.poll_interval, yield_rate=src.yield_rate)
+            for stype, sfunc in self.services
+            for src, channels in SubscribeSource.get_due_subs(stype, sfunc, now)
+        ]
+
+    def run(self, jobs: Optional[List[SubsJob]] = None) -> List[SubsResult]:
+        if jobs is None:
+            jobs = self.jobs()
+        start = time.monotonic()
+        results = []
+        with ExitStack() as stack:
+            executors = {
+                stype: stack.enter_context(ThreadPoolExecutor(max_workers=cap, thread_name_prefix=f"subs-{stype.value}"))
+                for stype, cap in self.caps.items()
+            }
+            futures = [executors[job.stype].submit(self.poll, job) for job in jobs]
+            for fut in as_completed(futures):
+                results.append(fut.result())
+        self.report(results, time.monotonic() - start)
+        return results
+
+    def poll(self, job: SubsJob) -> SubsResult:
+        result = SubsResult(job=job)
+        service = self.services[(job.stype, job.sfunc)]
+        polled_at = datetime.utcnow()
+        start = time.monotonic()
+        deadline = start + self.limit.subscribe_timeout
+        try:
+            index_items = self.collect(service.subscribe_index(job.name, job.cursor), deadline, job.cursor)
+            full_items = self.collect(service.subscribe_full(job.name, job.cursor), deadline, job.cursor)
+            result.seen = len(index_items) + len(full_items)
+            result.new = ingest_items(job.stype, job.sfunc, job.name, job.channels, index_items, full_items)
+            # Only move the cursor once the items before it are safely queued
+            newest = (index_items or full_items)[:1]
+            if newest and newest[0].item_id != job.cursor:
+                SubscribeSource.set_cursor(job.stype, job.sfunc, job.name, newest[0].item_id)
+        except SubsTimeout:
+            result.timed_out = True
+            print("SUBS TIMEOUT", job.stype.value, job.sfunc, job.name)
+        except Exception as err:
+            traceback.print_exc()
+            result.error = repr(err)
+        result.elapsed = time.monotonic() - start
+        interval, yield_rate = next_poll_interval(job, result, polled_at, self.limit)
+        SubscribeSource.schedule_poll(job.stype, job.sfunc, job.name, polled_at, interval, yield_rate)
+        return result
+
+    @staticmethod
+    def collect(items: Iterable[T], deadline: float, cursor: Optional[str] = None) -> List[T]:
+        """
+        Drains a subscription iterator, giving up once the source has used up its time.
+        The check runs between items, a single request that hangs is only bounded by its own timeout.
+        Iteration stops at the cursor, for the services that can't use it in their API.
+        """
+        result = []
+        for it in items:
+            if cursor is not None and it.item_id == cursor:
+                break
+            result.append(it)
+            if time.monotonic() > deadline:
+                raise SubsTimeout()
+        return result
+
+    @staticmethod
+    def report(results: List[SubsResult], elapsed: float):
+        seen = sum(r.seen for r in results)
+        new = sum(r.new for r in results)
+        errors = sum(1 for r in results if r.error is not None)
+        timeouts = sum(1 for r in results if r.timed_out)
+        elapsed = max(elapsed, 1e-6)
+        print(f"Polled {len(results)} subscriptions in {elapsed:.1f}s: "
+              f"{seen} items, {new} new, {errors} errors, {timeouts} timeouts "
+              f"({len(results) / elapsed:.2f} subs/s, {seen / elapsed:.1f} items/s)")
+        for stype in sorted({r.job.stype for r in results}, key=lambda t: t.value):
+            rs = [r for r in results if r.job.stype == stype]
+            busy = sum(r.elapsed for r in rs)
+            print(f"  {stype.value}: {len(rs)} subscriptions, {sum(r.new for r in rs)} new, "
+                  f"{busy:.1f}s busy, slowest {max(r.elapsed for r in rs):.1f}s")
+
+
+def next_poll_interval(job: SubsJob, result: SubsResult, polled_at: datetime,
+                       limit: LimitConfig) -> Tuple[timedelta, Optional[float]]:
+    """
+    Picks when to poll a subscription again, from the rate of new items it yielded so far.
+    The rate (new items per hour) is smoothed over past polls, and the next poll is set to when about one new item
+    is expected. Quiet, failing or missing sources back off exponentially up to the max interval.
+    """
+    min_interval = timedelta(minutes=limit.subscribe_min_interval)
+    max_interval = timedelta(minutes=limit.subscribe_max_interval)
+    if job.poll_interval is None:
+        prev_interval = timedelta(minutes=limit.subscribe_interval)
+    else:
+        prev_interval = timedelta(seconds=job.poll_interval)
+    yield_rate = job.yield_rate
+    if result.error is not None or result.timed_out:
+        interval = prev_interval * 2
+    else:
+        if job.last_poll_at is None:
+            # The first poll lists the whole window, it says nothing about the posting rate
+            observed = None
+        else:
+            hours = max((polled_at - job.last_poll_at).total_seconds(), min_interval.total_seconds()) / 3600
+            observed = result.new / hours
+        if observed is not None:
+            yield_rate = observed if yield_rate is None else 0.5 * observed + 0.5 * yield_rate
+        if result.new > 0 and yield_rate:
+            interval = timedelta(hours=1 / yield_rate)
+        elif result.new > 0:
+            interval = prev_interval
+        else:
+            interval = prev_interval * 2
+    # Spread the polls so sources added together don't stay in lockstep
+    interval *= random.uniform(0.9, 1.1)
+    interval = min(max(interval, min_interval), max_interval)
+    return interval, yield_rate
+
+
+def ingest_items(stype: ServiceType, sfunc: str, name: str, channels: List[str],
+                 index_items: Iterable[IndexItem], full_items: Iterable[FullItem]) -> int:
+    """
+    Queues the items of one subscription that haven't been seen before, returns how many were new.
+    """
+    index_items = unique_items(index_items)
+    full_items = unique_items(full_items)
+    index_keys = {(it.service, it.item_id) for it in index_items}
+    full_items = [it for it in full_items if (it.service, it.item_id) not in index_keys]
+    existing = ItemInfo.existing_keys(
+        [(it.service, it.item_id) for it in index_items] + [(it.service, it.item_id) for it in full_items]
+    )
+    new_index = [it for it in index_items if (it.service, it.item_id) not in existing]
+    new_full = [it for it in full_items if (it.service, it.item_id) not in existing]
+    for item in new_index + new_full:
+        print(stype.value, sfunc, name, item)
+    ItemInfo.add_indexes(new_index, channels, TaskStage.Fetching, TaskStatus.Queued)
+    ItemInfo.add_items(new_full, channels, TaskStage.Downloading, TaskStatus.Queued)
+    return len(new_index) + len(new_full)
+
+
+def unique_items(items):
+    seen = set()
+    result = []
+    for it in items:
+        key = (it.service, it.item_id)
+        if key not in seen:
+            seen.add(key)
+            result.append(it)
+    return result
+
@@ -1,4 +1,3 @@
-import time
 import traceback
 from functools import lru_cache
 
@@ -16,7 +15,6 @@ config = load_config()
 def update_index():
     for item in ItemInfo.poll_status_index(TaskStage.Fetching, TaskStatus.Queued, limit=config.limit.fetch):
         service = get_service(item.service)
-        ItemInfo.set_status(item.service, item.item_id, TaskStage.Fetching, TaskStatus.Pending)
         try:
             full_item = service.pull_item(IndexItem(item.service, item.item_id))
         except Exception as err:
@@ -29,7 +27,6 @@ def update_index():
             else:
                 ItemInfo.add_item(full_item, [])
                 ItemInfo.set_status(item.service, item.item_id, TaskStage.Downloading, TaskStatus.Queued)
-        time.sleep(1)
     ItemInfo.abandon_tasks(TaskStage.Fetching, TaskStatus.Queued, 20, TaskStage.Fetching, TaskStatus.Failed)
 
 
@@ -0,0 +1,141 @@
+import mmap
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from io import BytesIO
+from pathlib import Path
+from typing import IO, Dict, Optional
+
+import gridfs
+from mongoengine.connection import get_db
+
+from src.utils.project_path import project_root
+
+# Mode of files created with open(), mkstemp only gives access to the owner.
+# The umask can only be read by setting it, which isn't safe once threads are running.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+class BlobStore(ABC):
+    """
+    Image bytes addressed by key. Keys are content hashes, so writing a key that already exists is a no-op.
+    """
+    name: str
+    # Reading from the store goes through the network
+    remote: bool
+
+    @abstractmethod
+    def put(self, key: str, data: bytes, content_type: str):
+        pass
+
+    @abstractmethod
+    def open(self, key: str) -> IO:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+
+class GridFSBlobStore(BlobStore):
+    name = 'gridfs'
+    remote = True
+
+    @property
+    def fs(self) -> gridfs.GridFS:
+        return gridfs.GridFS(get_db())
+
+    def put(self, key: str, data: bytes, content_type: str):
+        fs = self.fs
+        if not fs.exists(filename=key):
+            fs.put(data, filename=key, content_type=content_type)
+
+    def open(self, key: str) -> IO:
+        return self.fs.get_last_version(filename=key)
+
+    def delete(self, key: str):
+        fs = self.fs
+        for f in fs.find({'filename': key}):
+            fs.delete(f._id)
+
+    def exists(self, key: str) -> bool:
+        return self.fs.exists(filename=key)
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Files in a directory sharded by the first bytes of the key, e.g. `ab/cd/abcd...`.
+    Files are written to a temporary name and renamed into place, readers never see a partial file.
+    """
+    name = 'local'
+    remote = False
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / key[2:4] / key
+
+    def put(self, key: str, data: bytes, content_type: str):
+        fp = self.path(key)
+        if fp.exists():
+            return
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=fp.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            # Blobs are hardlinked into push targets, they must be readable like any other file
+            os.chmod(tmp, FILE_MODE)
+            os.replace(tmp, fp)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def open(self, key: str) -> IO:
+        with self.path(key).open('rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                return BytesIO()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self, key: str):
+        try:
+            self.path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def exists(self, key: str) -> bool:
+        return self.path(key).exists()
+
+
+_stores: Dict[str, BlobStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_blob_store(name: Optional[str] = None) -> BlobStore:
+    """
+    The store called `name`, or the configured one that new blobs are written to.
+    """
+    # Imported here to keep src.config out of the import graph of the models.
+    from src.config import load_config
+    conf = load_config().cache
+    name = name or conf.backend
+    with _stores_lock:
+        if name not in _stores:
+            if name == GridFSBlobStore.name:
+                _stores[name] = GridFSBlobStore()
+            elif name == LocalBlobStore.name:
+                _stores[name] = LocalBlobStore(project_root / conf.root)
+            else:
+                raise ValueError(f"Unknown blob store: {name}")
+        return _stores[name]
@@ -0,0 +1,30 @@
+import threading
+import time
+from functools import wraps
+
+
+def ttl_cache(seconds: float):
+    """
+    Caches the result of a function without arguments for a few seconds.
+    """
+    def decorator(func):
+        lock = threading.Lock()
+        state = {'expires': 0.0, 'value': None}
+
+        @wraps(func)
+        def wrapper():
+            with lock:
+                now = time.monotonic()
+                if now >= state['expires']:
+                    state['value'] = func()
+                    state['expires'] = now + seconds
+                return state['value']
+
+        def cache_clear():
+            with lock:
+                state['expires'] = 0.0
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
@@ -0,0 +1,179 @@
+import math
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from typing import Optional, Tuple, Callable, IO
+
+from PIL import Image
+
+# Formats that are kept as they were downloaded, with the file extension used when pushing them
+IMAGE_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+}
+SPOOL_CHUNK_SIZE = 2 ** 20
+
+
+class ImageHandle:
+    """
+    A cached image that is only read when a push service opens it.
+    Every `open` returns a new stream from the first byte. Streams of remote stores are spooled first,
+    so a slow upload doesn't keep the database busy, and memory stays bounded by `spool_size`.
+    `path` is a local file with the same bytes, when there is one. It must not be modified.
+    """
+
+    def __init__(self, opener: Callable[[], IO], content_type: str = 'image/png', size: Optional[int] = None,
+                 sha256: Optional[str] = None, remote: bool = False, spool_size: int = 8 * 2 ** 20,
+                 path: Optional[Path] = None):
+        self.opener = opener
+        self.content_type = content_type
+        self.size = size
+        self.sha256 = sha256
+        self.remote = remote
+        self.spool_size = spool_size
+        self.path = path
+
+    @classmethod
+    def from_bytes(cls, data: bytes, content_type: str = 'image/png') -> 'ImageHandle':
+        return cls(lambda: BytesIO(data), content_type, len(data))
+
+    @property
+    def extension(self) -> str:
+        return extension_for(self.content_type)
+
+    def open(self) -> IO:
+        if not self.remote:
+            return self.opener()
+        buf = SpooledTemporaryFile(max_size=self.spool_size)
+        with closing(self.opener()) as f:
+            shutil.copyfileobj(f, buf, SPOOL_CHUNK_SIZE)
+        buf.seek(0)
+        return buf
+
+    def read(self) -> bytes:
+        with closing(self.open()) as f:
+            return f.read()
+
+    def pin(self, path: Path) -> 'ImageHandle':
+        """
+        A handle on a copy of a remote image in the local file `path`.
+        Reads the cache once for an image that is pushed to several targets.
+        """
+        if not self.remote:
+            return self
+        with closing(self.opener()) as src, path.open('wb') as dst:
+            shutil.copyfileobj(src, dst, SPOOL_CHUNK_SIZE)
+        return ImageHandle(partial(path.open, 'rb'), self.content_type, self.size, self.sha256, path=path)
+
+
+def extension_for(content_type: Optional[str]) -> str:
+    return IMAGE_EXTENSIONS.get(content_type, '.png')
+
+
+def sniff_content_type(data: bytes) -> Optional[str]:
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def encode_png(raw: bytes) -> bytes:
+    """
+    Decodes an image and encodes it again as PNG. Runs in a worker process.
+    """
+    img = Image.open(BytesIO(raw))
+    with BytesIO() as buf:
+        img.save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def normalize_image(raw: bytes) -> Tuple[bytes, str]:
+    """
+    Checks that downloaded bytes are a complete image, and returns them with their content type.
+    Common web formats are kept as they are, anything else is transcoded to PNG. Runs in a worker process.
+    """
+    content_type = sniff_content_type(raw)
+    if content_type not in IMAGE_EXTENSIONS:
+        return encode_png(raw), 'image/png'
+    img = Image.open(BytesIO(raw))
+    # Decoding catches truncated downloads and error pages, it is much cheaper than encoding a PNG
+    img.load()
+    return raw, content_type
+
+
+@dataclass(frozen=True)
+class RenditionSpec:
+    """
+    A resized copy of an image that a push service sends instead of the original.
+    """
+    max_edge: int
+    # 'JPEG' or 'WEBP'
+    format: str = 'JPEG'
+    quality: int = 85
+    max_bytes: int = 10 * 2 ** 20
+
+    @property
+    def key(self) -> str:
+        return f"{self.format.lower()}-{self.max_edge}-q{self.quality}"
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.format.lower()}"
+
+
+def render_image(raw: bytes, spec: RenditionSpec) -> Optional[bytes]:
+    """
+    Shrinks an image to fit `spec`, or returns None when it would be too small to send. Runs in a worker process.
+    """
+    img = Image.open(BytesIO(raw))
+    width, height = img.size
+    scale = min(spec.max_edge / max(width, height), 1)
+    if scale < 1:
+        if min(width, height) * scale < 5:
+            return None
+        if img.format == 'JPEG':
+            # Lets the decoder skip most of the pixels, the result is still at least as large as the target
+            img.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+        img.thumbnail((spec.max_edge, spec.max_edge), Image.LANCZOS)
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, 'white')
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    quality = spec.quality
+    while True:
+        with BytesIO() as buf:
+            img.save(buf, format=spec.format, quality=quality)
+            if buf.tell() <= spec.max_bytes or quality <= 40:
+                return buf.getvalue()
+        quality -= 10
+
+
+_render_pool: Optional[ProcessPoolExecutor] = None
+_render_pool_lock = threading.Lock()
+
+
+def get_render_pool(processes: int = 0) -> ProcessPoolExecutor:
+    """
+    The process pool shared by the renditions of this process, `processes` is only used when creating it.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(max_workers=processes or None)
+        return _render_pool
@@ -0,0 +1,196 @@
+import email.utils
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Mapping, Optional, Dict, List
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.enums import ServiceType
+
+
+@dataclass
+class RateLimit:
+    # Requests per second, and how many may be sent at once after an idle period
+    rate: float
+    burst: int = 1
+
+
+DEFAULT_RATE_LIMITS: Mapping[ServiceType, RateLimit] = {
+    ServiceType.Pixiv: RateLimit(rate=1.0, burst=2),
+    ServiceType.Fanbox: RateLimit(rate=0.5, burst=1),
+    ServiceType.Twitter: RateLimit(rate=2.0, burst=4),
+    ServiceType.Weibo: RateLimit(rate=1.0, burst=2),
+    ServiceType.Telegram: RateLimit(rate=0.5, burst=3),
+}
+
+
+@dataclass
+class RateLimitConfig:
+    services: Mapping[str, RateLimit] = field(default_factory=dict)
+    hosts: Mapping[str, RateLimit] = field(default_factory=dict)
+    max_retries: int = 3
+
+    def service_limit(self, stype: ServiceType) -> Optional[RateLimit]:
+        return self.services.get(stype.value, DEFAULT_RATE_LIMITS.get(stype))
+
+
+def parse_rate_limits(d) -> RateLimitConfig:
+    return RateLimitConfig(
+        services={
+            ServiceType(k).value: RateLimit(**v)
+            for k, v in d.get('service', {}).items()
+        },
+        hosts={
+            k: RateLimit(**v)
+            for k, v in d.get('host', {}).items()
+        },
+        max_retries=d.get('max_retries', 3)
+    )
+
+
+class TokenBucket:
+    def __init__(self, limit: RateLimit):
+        self.rate = limit.rate
+        self.capacity = max(limit.burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        # A request can't cost more than a full bucket, or it would never be sent
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                else:
+                    wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def paused_for(self) -> float:
+        with self.lock:
+            return max(self.paused_until - time.monotonic(), 0)
+
+    def pause(self, seconds: float):
+        """
+        Holds every request for a while, when the server asked us to back off.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+            self.updated = now
+
+
+class RateLimiter:
+    """
+    Token buckets per service type and per host.
+    A host with its own limit uses only its bucket, it may be faster or slower than the rest of the service.
+    Other hosts share the bucket of the service.
+    """
+
+    def __init__(self, config: RateLimitConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.services: Dict[ServiceType, Optional[TokenBucket]] = {}
+        self.hosts: Dict[str, Optional[TokenBucket]] = {}
+
+    def buckets(self, stype: ServiceType, host: Optional[str] = None) -> List[TokenBucket]:
+        with self.lock:
+            if stype not in self.services:
+                limit = self.config.service_limit(stype)
+                self.services[stype] = limit and TokenBucket(limit)
+            bucket = self.services[stype]
+            if host is not None:
+                if host not in self.hosts:
+                    limit = self.config.hosts.get(host)
+                    self.hosts[host] = limit and TokenBucket(limit)
+                bucket = self.hosts[host] or bucket
+        return [bucket] if bucket is not None else []
+
+    def acquire(self, stype: ServiceType, host: Optional[str] = None):
+        for b in self.buckets(stype, host):
+            b.acquire()
+
+    def pause(self, stype: ServiceType, host: Optional[str], seconds: float):
+        print("Rate limited:", stype.value, host, f"{seconds:.1f}s")
+        for b in self.buckets(stype, host):
+            b.pause(seconds)
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            # Imported here, src.config imports the services which use this module.
+            from src.config import load_config
+            _limiter = RateLimiter(load_config().ratelimit)
+        return _limiter
+
+
+def parse_retry_after(response: requests.Response) -> Optional[float]:
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    Waits for the token buckets of the service and host before every request,
+    and retries 429/503 responses after the delay the server asked for.
+    """
+
+    def __init__(self, stype: ServiceType, limiter: RateLimiter, **kwargs):
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+        self.stype = stype
+        self.limiter = limiter
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).hostname
+        # Streamed bodies can't be sent twice
+        replayable = request.body is None or isinstance(request.body, (bytes, str))
+        retries = self.limiter.config.max_retries if replayable else 0
+        attempt = 0
+        while True:
+            self.limiter.acquire(self.stype, host)
+            response = super(RateLimitedAdapter, self).send(request, **kwargs)
+            if response.status_code not in (429, 503) or attempt >= retries:
+                return response
+            delay = parse_retry_after(response)
+            if delay is None:
+                if response.status_code == 503:
+                    return response
+                delay = 2 ** attempt * 5
+            self.limiter.pause(self.stype, host, delay)
+            response.close()
+            attempt += 1
+
+
+def rate_limited(sess: requests.Session, stype: ServiceType) -> requests.Session:
+    adapter = RateLimitedAdapter(stype, get_rate_limiter())
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    return sess
@@ -0,0 +1,14 @@
+import os
+import socket
+from functools import lru_cache
+
+
+@lru_cache(1)
+def get_worker_id() -> str:
+    """
+    Identifies this worker when it claims queued tasks.
+    Defaults to the hostname. Docker keeps it across restarts, but a container recreated by compose gets a new one,
+    and the claims of the old container are then only given back once their lease runs out.
+    Set OCTO_WORKER_ID to keep the id across containers, or to run several workers of the same stage on one host.
+    """
+    return os.environ.get('OCTO_WORKER_ID') or socket.gethostname()
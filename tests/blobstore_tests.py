@@ -0,0 +1,42 @@
+import os
+import stat
+import tempfile
+import unittest
+from pathlib import Path
+
+from src.utils.blobstore import LocalBlobStore, FILE_MODE
+
+
+class LocalBlobStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = LocalBlobStore(Path(self.tmp.name))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_put_open(self):
+        self.store.put('abcdef', b'data', 'image/png')
+        self.assertTrue(self.store.path('abcdef').samefile(Path(self.tmp.name) / 'ab' / 'cd' / 'abcdef'))
+        with self.store.open('abcdef') as f:
+            self.assertEqual(f.read(), b'data')
+        self.assertEqual(list(self.store.path('abcdef').parent.iterdir()), [self.store.path('abcdef')])
+
+    def test_mode(self):
+        # Same mode as a file written with open(), blobs are hardlinked into push targets
+        self.store.put('abcdef', b'data', 'image/png')
+        self.assertEqual(stat.S_IMODE(os.stat(self.store.path('abcdef')).st_mode), FILE_MODE)
+
+    def test_empty(self):
+        self.store.put('abcdef', b'', 'image/png')
+        self.assertEqual(self.store.open('abcdef').read(), b'')
+
+    def test_delete(self):
+        self.store.put('abcdef', b'data', 'image/png')
+        self.store.delete('abcdef')
+        self.assertFalse(self.store.exists('abcdef'))
+        self.store.delete('abcdef')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+from io import BytesIO
+
+from PIL import Image
+
+from src.utils.images import normalize_image, sniff_content_type, extension_for, ImageHandle, RenditionSpec, \
+    render_image
+
+
+def encode(fmt):
+    buf = BytesIO()
+    Image.new('RGB', (32, 24), 'red').save(buf, format=fmt)
+    return buf.getvalue()
+
+
+class ImagesTestCase(unittest.TestCase):
+    def test_sniff(self):
+        self.assertEqual(sniff_content_type(encode('JPEG')), 'image/jpeg')
+        self.assertEqual(sniff_content_type(encode('PNG')), 'image/png')
+        self.assertEqual(sniff_content_type(encode('WEBP')), 'image/webp')
+        self.assertIsNone(sniff_content_type(b'<html></html>'))
+
+    def test_keep_original(self):
+        raw = encode('JPEG')
+        data, content_type = normalize_image(raw)
+        self.assertIs(data, raw)
+        self.assertEqual(extension_for(content_type), '.jpg')
+
+    def test_transcode_other_formats(self):
+        data, content_type = normalize_image(encode('BMP'))
+        self.assertEqual(content_type, 'image/png')
+        self.assertEqual(sniff_content_type(data), 'image/png')
+
+    def test_reject_truncated(self):
+        raw = encode('JPEG')
+        with self.assertRaises(OSError):
+            normalize_image(raw[:len(raw) // 2])
+
+    def test_handle_reopen(self):
+        raw = encode('PNG')
+        handle = ImageHandle(lambda: BytesIO(raw), 'image/png', remote=True, spool_size=16)
+        self.assertEqual(handle.read(), raw)
+        self.assertEqual(handle.read(), raw)
+        self.assertEqual(handle.extension, '.png')
+
+    def test_render(self):
+        buf = BytesIO()
+        Image.new('RGBA', (400, 100), (0, 0, 0, 0)).save(buf, format='PNG')
+        data = render_image(buf.getvalue(), RenditionSpec(max_edge=200))
+        self.assertEqual(sniff_content_type(data), 'image/jpeg')
+        self.assertEqual(Image.open(BytesIO(data)).size, (200, 50))
+        self.assertIsNone(render_image(encode('JPEG'), RenditionSpec(max_edge=4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
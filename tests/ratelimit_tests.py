@@ -0,0 +1,59 @@
+import time
+import unittest
+
+import requests
+
+from src.enums import ServiceType
+from src.utils.ratelimit import TokenBucket, RateLimit, RateLimiter, RateLimitConfig, parse_retry_after
+
+
+class RateLimitTestCase(unittest.TestCase):
+    def test_burst(self):
+        bucket = TokenBucket(RateLimit(rate=10, burst=3))
+        start = time.monotonic()
+        for _ in range(3):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.05)
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.08)
+
+    def test_pause(self):
+        bucket = TokenBucket(RateLimit(rate=100, burst=10))
+        bucket.pause(0.2)
+        start = time.monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_cost(self):
+        bucket = TokenBucket(RateLimit(rate=10, burst=3))
+        bucket.acquire(3)
+        start = time.monotonic()
+        # Capped to the bucket size
+        bucket.acquire(10)
+        self.assertGreaterEqual(time.monotonic() - start, 0.28)
+        bucket.pause(1)
+        self.assertGreater(bucket.paused_for(), 0.9)
+
+    def test_unlimited_service(self):
+        limiter = RateLimiter(RateLimitConfig())
+        self.assertEqual(limiter.buckets(ServiceType.Local, 'localhost'), [])
+        self.assertEqual(len(limiter.buckets(ServiceType.Pixiv, 'i.pximg.net')), 1)
+
+    def test_host_limit(self):
+        limiter = RateLimiter(RateLimitConfig(hosts={'i.pximg.net': RateLimit(rate=5)}))
+        # The host limit replaces the service limit, it can be faster
+        buckets = limiter.buckets(ServiceType.Pixiv, 'i.pximg.net')
+        self.assertEqual(len(buckets), 1)
+        self.assertEqual(buckets[0].rate, 5)
+        self.assertIsNot(buckets[0], limiter.buckets(ServiceType.Pixiv, 'www.pixiv.net')[0])
+
+    def test_retry_after(self):
+        res = requests.Response()
+        res.headers['Retry-After'] = '12'
+        self.assertEqual(parse_retry_after(res), 12)
+        res.headers['Retry-After'] = 'not a date'
+        self.assertIsNone(parse_retry_after(res))
+
+
+if __name__ == '__main__':
+    unittest.main()
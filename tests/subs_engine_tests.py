@@ -0,0 +1,61 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from src.config import LimitConfig
+from src.enums import ServiceType
+from src.tasks.subs_engine import SubsJob, SubsResult, next_poll_interval
+
+
+class NextPollIntervalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.limit = LimitConfig(fetch=50, download=20, subscribe_interval=47, subscribe_min_interval=15,
+                                 subscribe_max_interval=7 * 24 * 60)
+        self.now = datetime(2026, 1, 1, 12)
+
+    def job(self, last_poll_hours=None, poll_interval=None, yield_rate=None):
+        last_poll_at = None if last_poll_hours is None else self.now - timedelta(hours=last_poll_hours)
+        return SubsJob(stype=ServiceType.Twitter, sfunc='username', name='name', channels=[],
+                       last_poll_at=last_poll_at, poll_interval=poll_interval, yield_rate=yield_rate)
+
+    def next(self, job, new=0, error=None):
+        return next_poll_interval(job, SubsResult(job=job, new=new, error=error), self.now, self.limit)
+
+    def assertAround(self, interval, expected):
+        self.assertGreaterEqual(interval, expected * 0.9)
+        self.assertLessEqual(interval, expected * 1.1)
+
+    def test_first_poll(self):
+        # The first poll lists the whole window, it doesn't set a rate
+        interval, yield_rate = self.next(self.job(), new=30)
+        self.assertIsNone(yield_rate)
+        self.assertAround(interval, timedelta(minutes=47))
+
+    def test_active_source(self):
+        interval, yield_rate = self.next(self.job(last_poll_hours=2, poll_interval=7200, yield_rate=1.0), new=2)
+        self.assertAlmostEqual(yield_rate, 1.0)
+        self.assertAround(interval, timedelta(hours=1))
+
+    def test_quiet_source(self):
+        interval, yield_rate = self.next(self.job(last_poll_hours=1, poll_interval=3600, yield_rate=0.5))
+        self.assertAlmostEqual(yield_rate, 0.25)
+        self.assertAround(interval, timedelta(hours=2))
+
+    def test_error_backoff(self):
+        interval, yield_rate = self.next(self.job(last_poll_hours=1, poll_interval=3600, yield_rate=0.5),
+                                         error='boom')
+        self.assertEqual(yield_rate, 0.5)
+        self.assertAround(interval, timedelta(hours=2))
+
+    def test_clamping(self):
+        limit = self.limit
+        with patch('random.uniform', return_value=0.9):
+            interval, _ = self.next(self.job(last_poll_hours=1, poll_interval=3600, yield_rate=100), new=100)
+        self.assertEqual(interval, timedelta(minutes=limit.subscribe_min_interval))
+        with patch('random.uniform', return_value=1.1):
+            interval, _ = self.next(self.job(last_poll_hours=24 * 7, poll_interval=7 * 24 * 3600), error='boom')
+        self.assertEqual(interval, timedelta(minutes=limit.subscribe_max_interval))
+
+
+if __name__ == '__main__':
+    unittest.main()